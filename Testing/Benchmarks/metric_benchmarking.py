@@ -126,3 +126,20 @@ def score_with_correlation_benchmarking():
             end = time.time()
             print(end-start)
             benchmarking_results.append([traces,sam,end-start])
+
+def bootstrap_success_rate_guessing_entropy_benchmarking():
+    trace_counts = [100, 1000, 10000, 20000, 30000, 50000]
+    num_of_experiments = [8, 16, 32, 128]
+    benchmarking_results = []
+    unmasked_random = np.random.random_sample((100000, 10))
+    texts = np.random.randint(16, size=(100000, 16))
+    key = np.random.randint(256, size=16)
+
+    for exp in num_of_experiments:
+        start = time.time()
+        bootstrap_success_rate_guessing_entropy(unmasked_random, texts, key, trace_counts,
+                                                leakage_model_hamming_distance, num_experiments=exp)
+        end = time.time()
+        print(end - start)
+        benchmarking_results.append([exp, end - start])
+    print(benchmarking_results)
@@ -1,6 +1,13 @@
 #The second order DPA code is inspired by https://github.com/ermin-sakic/second-order-dpa by Ermin Sakic
 import numpy as np
 import math
+from multiprocessing.pool import ThreadPool
+
+from WPI_SCA_LIBRARY.Metrics import StreamingSNR, pearson_correlation_matrix, rank_key_scores
+
+# popcount of every 16-bit word
+HammingWeight16 = np.unpackbits(np.arange(2 ** 16, dtype=np.uint16).view(np.uint8).reshape(-1, 2), axis=1).sum(
+    axis=1, dtype=np.uint8)
 
 
 def intermediate_value(out):
@@ -9,6 +16,14 @@ def intermediate_value(out):
     return bin(a_ma ^ b_ma).count("1")
 
 
+def intermediate_values(out):
+    # vectorized intermediate_value over a (num_traces, 16) output array, popcount through a 16-bit lookup table
+    out = np.asarray(out).astype(np.uint16)
+    a_ma = (out[:, 14] << 8) | out[:, 15]  # out0
+    b_ma = (out[:, 12] << 8) | out[:, 13]  # out1
+    return HammingWeight16[a_ma ^ b_ma]
+
+
 def std_dev(x, x_bar):
     return np.sqrt(np.sum((x - x_bar) ** 2, axis=0))
 
@@ -17,189 +32,263 @@ def cov(x, x_bar, y, y_bar):
     return np.sum((x - x_bar) * (y - y_bar), axis=0)
 
 
-def calculate_window_averages(traces, window_size=5, traces_max=0):
-    fma = []
-    i = 0
+def calculate_window_averages(traces, window_size=5, traces_max=0, out=None, chunk_size=4096):
+    # moving average over consecutive traces from prefix sums, out[i] = mean(traces[i:i + window_size]).
+    # Traces are read chunk_size windows at a time so memory-mapped trace files are streamed, and the averages are
+    # written straight into out, which may itself be a memory-mapped array.
+    num_traces = traces.shape[0]
     if traces_max == 0:
-        traces_max = traces.shape[0] - window_size
-
-    while i < traces_max:
-        window_average_increment = np.mean(traces[i:i + window_size], axis=0)
-        fma.append(window_average_increment)
-        i += 1
-    return fma
-
-
-def calculate_dpa(traces, iv, order=1, key_guess=0, window_size_fma=5, num_of_traces=0):
+        traces_max = num_traces - window_size
+    traces_max = max(0, min(traces_max, num_traces - window_size + 1))
+
+    if out is None:
+        out = np.empty((traces_max,) + traces.shape[1:], dtype=np.float32)
+    elif out.shape[0] < traces_max:
+        raise ValueError("out must have at least traces_max rows")
+
+    for start in range(0, traces_max, chunk_size):
+        end = min(start + chunk_size, traces_max)
+        block = np.asarray(traces[start:end + window_size - 1], dtype=np.float64)
+        prefix = np.zeros((block.shape[0] + 1,) + block.shape[1:])
+        np.cumsum(block, axis=0, out=prefix[1:])
+        np.subtract(prefix[window_size:], prefix[:-window_size], out=prefix[window_size:])
+        np.divide(prefix[window_size:], window_size, out=out[start:end], casting='same_kind')
+    return out[:traces_max]
+
+
+def calculate_dpa(traces, iv, order=1, key_guess=0, window_size_fma=5, num_of_traces=0, hypothesis_fcn=None,
+                  key_guesses=range(256), return_ranking=False, pairs=None):
     if order == 1:
-        max_cpa = [0] * 1
-
         num_trace = len(traces)
 
-        t_bar = np.mean(traces, axis=0)
-        o_t = std_dev(traces, t_bar)
-
-        hws = np.array([[intermediate_value(textout) for textout in iv[0:num_trace]]]).transpose()
-        hws_bar = np.mean(hws, axis=0)
+        if hypothesis_fcn is None:
+            # key independent hypothesis, a single column for the fixed key_guess
+            key_guesses = np.array([key_guess])
+            hws = intermediate_values(iv[0:num_trace]).reshape(-1, 1)
+        else:
+            # hypothesis_fcn(iv, key_guesses) returns a (num_trace, len(key_guesses)) hypothesis matrix
+            key_guesses = np.array(list(key_guesses))
+            hws = hypothesis_fcn(iv[0:num_trace], key_guesses)
 
-        o_hws = std_dev(hws, hws_bar)
-        correlation = cov(traces, t_bar, hws, hws_bar)
-        cpa_output = correlation / (o_t * o_hws)
+        cpa_output = pearson_correlation_matrix(hws, traces)
+        max_cpa = np.max(np.abs(cpa_output), axis=1)
+        ranking = rank_key_scores(key_guesses, max_cpa)
 
-        max_cpa[key_guess] = max(abs(cpa_output))
+        guess = ranking[0]['key']
+        guess_corr = ranking[0]['score']
 
-        guess = np.argmax(max_cpa)
-        guess_corr = max(max_cpa)
+        if hypothesis_fcn is None:
+            cpa_output = cpa_output[0]
 
+        if return_ranking:
+            return cpa_output, guess_corr, guess, ranking
         return cpa_output, guess_corr, guess
 
     if order == 2:
+        traces_max = traces.shape[0] - window_size_fma
         if num_of_traces != 0:
-            fma = calculate_window_averages(traces, window_size=window_size_fma)
-            traces = np.array(fma[0:num_of_traces])
-        else:
-            fma = calculate_window_averages(traces, window_size=window_size_fma)
-            traces = np.array(fma)
-            num_of_traces = traces.shape[0]
-
-        length_vector = traces.shape[1]
-        P = np.zeros((num_of_traces, int((length_vector - 1) * length_vector / 2)))
-
-        e = 0
-        s = 0
-        for i in range(length_vector):
-            e = s + length_vector - i - 1
-            P[:, s:e] = np.abs(np.subtract(traces[:, i + 1:], traces[:, i].reshape(-1, 1)))
-            s = e
-
-        dpa_trace = P
-        max_cpa = [0] * 1
-        num_trace = len(dpa_trace)
-        t_bar = np.mean(dpa_trace, axis=0)
-        o_t = std_dev(dpa_trace, t_bar)
-        k_guess = 0
-
-        hws = np.array([[intermediate_value(textout) for textout in iv[0:num_trace]]]).transpose()
-        hws_bar = np.mean(hws, axis=0)
-        o_hws = std_dev(hws, hws_bar)
-        correlation = cov(dpa_trace, t_bar, hws, hws_bar)
-        cpa_output = correlation / (o_t * o_hws)
-        max_cpa[k_guess] = max(abs(cpa_output))
-        guess = np.argmax(max_cpa)
-        guess_corr = max(max_cpa)
+            traces_max = min(num_of_traces, traces_max)
+        traces = calculate_window_averages(traces, window_size=window_size_fma, traces_max=traces_max)
+        num_of_traces = traces.shape[0]
+
+        hws = intermediate_values(iv[0:num_of_traces])
+        cpa_output = calculate_second_order_dpa_tiled(traces, hws, combine="abs-diff", pairs=pairs)
+        guess = 0
+        guess_corr = max(abs(cpa_output))
 
         return cpa_output, guess_corr, guess
 
 
 def calculate_second_order_dpa_mem_efficient(traces, IV, window_width):
-    num_of_samples = traces.shape[1]
-    num_of_traces = traces.shape[0]
-    P_normal_width = int((num_of_samples - 1) * num_of_samples / 2)
-
-    num_of_iterations = math.floor(P_normal_width / num_of_samples)
-
-    #predefine
-    cpaoutput = np.zeros(P_normal_width)
-    P = np.zeros((num_of_traces, window_width))
-
-    current_P_index = 0
-    current_partition_index = 0
-    for i in range(num_of_iterations):
-        current_num_in_P = 0
-
-        while current_num_in_P < window_width:
-            if current_partition_index == 0:
-                sub_array = np.abs(
-                    np.subtract(traces[:, current_P_index + 1:], traces[:, current_P_index].reshape(-1, 1)))
-                length_sub_array = sub_array.shape[1]
-
-                if length_sub_array + current_num_in_P <= window_width:
-                    P[:, current_num_in_P: current_num_in_P + length_sub_array] = sub_array
-                    current_num_in_P = current_num_in_P + length_sub_array
-                    current_P_index = current_P_index + 1
-                else:
-                    number_to_add = window_width - current_num_in_P
-                    P[:, current_num_in_P: window_width] = sub_array[:, 0:number_to_add]
-                    current_num_in_P = window_width
-                    current_partition_index = number_to_add
-            else:
-                sub_array = np.abs(
-                    np.subtract(traces[:, current_P_index + 1:], traces[:, current_P_index].reshape(-1, 1)))
-                length_sub_array = sub_array.shape[1]
-                num_left_to_add = length_sub_array - current_partition_index
-
-                if num_left_to_add <= window_width:
-                    P[:, current_num_in_P: num_left_to_add] = sub_array[:, current_partition_index:]
-                    current_num_in_P = current_num_in_P + num_left_to_add
-                    current_P_index = current_P_index + 1
-                    current_partition_index = 0
-
-                else:
-                    P[:] = sub_array[:, current_partition_index:current_partition_index + window_width]
-                    current_num_in_P = window_width
-                    current_partition_index = current_partition_index + window_width
-
-        #solve for cpa output
-        dpa_trace = P
-
-        t_bar = np.mean(dpa_trace)
-        o_t = std_dev(dpa_trace, t_bar)
-        hws = np.array([[intermediate_value(textout) for textout in IV[0:num_of_traces]]]).transpose()
-        hws_bar = np.mean(hws)
-        # hws_bar = mean(out[:,5])
-        o_hws = std_dev(hws, hws_bar)
-        correlation = cov(dpa_trace, t_bar, hws, hws_bar)
-        cpaoutput[i * window_width: (i * window_width) + window_width] = correlation / (o_t * o_hws)
-
-    #final run through
-    start_index = window_width * num_of_iterations
-    num_to_add = P_normal_width - start_index
-    current_num_in_P = 0
-    P = np.zeros((num_of_traces, num_to_add))
-
-    if num_to_add > 0:
-        while current_num_in_P < num_to_add:
-
-            if current_partition_index == 0:
-                sub_array = np.abs(
-                    np.subtract(traces[:, current_P_index + 1:], traces[:, current_P_index].reshape(-1, 1)))
-                length_sub_array = sub_array.shape[1]
-
-                if length_sub_array + current_num_in_P <= num_to_add:
-                    P[:, current_num_in_P: current_num_in_P + length_sub_array] = sub_array
-                    current_num_in_P = current_num_in_P + length_sub_array
-                    current_P_index = current_P_index + 1
-                else:
-                    number_to_add = num_to_add - current_num_in_P
-                    P[:, current_num_in_P: num_to_add] = sub_array[:, 0:number_to_add]
-                    current_num_in_P = num_to_add
-                    current_partition_index = number_to_add
-            else:
-                sub_array = np.abs(
-                    np.subtract(traces[:, current_P_index + 1:], traces[:, current_P_index].reshape(-1, 1)))
-                length_sub_array = sub_array.shape[1]
-                num_left_to_add = length_sub_array - current_partition_index
-
-                if num_left_to_add <= num_to_add:
-                    P[:, current_num_in_P: num_left_to_add] = sub_array[:, current_partition_index:]
-                    current_num_in_P = current_num_in_P + num_left_to_add
-                    current_P_index = current_P_index + 1
-                    current_partition_index = 0
-
-                else:
-                    P[:] = sub_array[:, current_partition_index:current_partition_index + num_to_add]
-                    current_num_in_P = num_to_add
-                    current_partition_index = current_partition_index + num_to_add
-
-        dpa_trace = P
-
-        t_bar = np.mean(dpa_trace)
-        o_t = std_dev(dpa_trace, t_bar)
-        hws = np.array([[intermediate_value(textout) for textout in IV[0:num_of_traces]]]).transpose()
-        hws_bar = np.mean(hws)
-        # hws_bar = mean(out[:,5])
-        o_hws = std_dev(hws, hws_bar)
-        correlation = cov(dpa_trace, t_bar, hws, hws_bar)
-        cpaoutput[start_index:] = correlation / (o_t * o_hws)
-
-    return cpaoutput
+    # P is never materialized, window_width only bounds the size of each tile
+    hws = intermediate_values(IV[0:traces.shape[0]])
+    return calculate_second_order_dpa_tiled(traces, hws, combine="abs-diff",
+                                            memory_budget=traces.shape[0] * window_width * 8)
+
+
+def select_poi_windows(traces, labels=None, n_windows=2, window_width=50, n_labels=256, chunk_size=4096):
+    # Picks points of interest for second order DPA as the windows of window_width samples around the SNR peaks.
+    # labels is either (num_traces,), in which case the n_windows best windows of that SNR are picked, or
+    # (num_traces, num_shares) with the label of each mask share, in which case one window is picked per share.
+    # Without labels the variance of the traces is used instead of the SNR. Windows never overlap.
+    num_traces, length_vector = traces.shape
+    if labels is None:
+        total = np.zeros(length_vector)
+        total_squared = np.zeros(length_vector)
+        for start in range(0, num_traces, chunk_size):
+            block = np.asarray(traces[start:start + chunk_size], dtype=np.float64)
+            total += np.sum(block, axis=0)
+            total_squared += np.sum(block ** 2, axis=0)
+        scores = [total_squared / num_traces - (total / num_traces) ** 2]
+        windows_per_score = n_windows
+    else:
+        labels = np.asarray(labels)
+        if labels.ndim == 1:
+            labels = labels.reshape(-1, 1)
+            windows_per_score = n_windows
+        else:
+            windows_per_score = 1
+        snrs = [StreamingSNR(n_labels, length_vector) for _ in range(labels.shape[1])]
+        for start in range(0, num_traces, chunk_size):
+            block = np.asarray(traces[start:start + chunk_size], dtype=np.float64)
+            for share, snr in enumerate(snrs):
+                snr.update(block, labels[start:start + chunk_size, share])
+        scores = [np.nan_to_num(snr.snr()) for snr in snrs]
+
+    window_width = min(window_width, length_vector)
+    free = np.ones(length_vector, dtype=bool)
+    windows = []
+    for score in scores:
+        for _ in range(windows_per_score):
+            # window sums of the score over the windows that do not overlap an already chosen window
+            prefix = np.concatenate(([0], np.cumsum(score)))
+            window_score = prefix[window_width:] - prefix[:-window_width]
+            blocked = np.concatenate(([0], np.cumsum(~free)))
+            window_score[(blocked[window_width:] - blocked[:-window_width]) > 0] = -np.inf
+            if not np.isfinite(window_score).any():
+                break
+            start = int(np.argmax(window_score))
+            windows.append((start, start + window_width))
+            free[start:start + window_width] = False
+    return windows
+
+
+def second_order_pairs(length_vector, windows=None, max_distance=None):
+    # Restricts the sample pairs (i, j), i < j, of second order DPA to those with their two samples in two different
+    # windows, to those at most max_distance samples apart, or to both. With more than two windows, such as one window
+    # per share from select_poi_windows, the pairs of every combination of two windows are combined. A single window,
+    # as select_poi_windows returns when only one window fits the trace, restricts the pairs to those inside it.
+    # Returns the (i, j) index arrays in pair_index order.
+    if windows is None and max_distance is None:
+        raise ValueError("Either windows or max_distance must be given")
+
+    if windows is not None:
+        if len(windows) == 0:
+            raise ValueError("windows must contain at least one (start, end) window")
+        window_pairs = [(windows[0], windows[0])] if len(windows) == 1 else [
+            (windows[a], windows[b]) for a in range(len(windows)) for b in range(a + 1, len(windows))]
+
+        i, j = [], []
+        for (a_start, a_end), (b_start, b_end) in window_pairs:
+            i_ab, j_ab = np.meshgrid(np.arange(a_start, a_end), np.arange(b_start, b_end), indexing='ij')
+            i.append(i_ab.ravel())
+            j.append(j_ab.ravel())
+        i, j = np.concatenate(i), np.concatenate(j)
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        keep = i != j
+        if max_distance is not None:
+            keep &= (j - i) <= max_distance
+        i, j = i[keep], j[keep]
+        # overlapping windows produce some pairs twice
+        _, first = np.unique(pair_index(i, j, length_vector), return_index=True)
+        return i[first], j[first]
+
+    distances = np.arange(1, min(max_distance, length_vector - 1) + 1)
+    i = np.concatenate([np.arange(length_vector - d) for d in distances]).astype(np.intp)
+    j = i + np.repeat(distances, length_vector - distances)
+    order = np.lexsort((j, i))
+    return i[order], j[order]
+
+
+def pair_index(i, j, length_vector):
+    # position of the sample pair (i, j), i < j, in the condensed output of second order DPA
+    return i * length_vector - i * (i + 1) // 2 + (j - i - 1)
+
+
+def calculate_second_order_dpa_tiled(traces, hypotheses, combine="abs-diff", tile_size=None, memory_budget=2 ** 28,
+                                     n_jobs=1, pairs=None):
+    # Correlates the hypotheses with every combined sample pair (i, j), i < j, without building the pair matrix P.
+    # The (i, j) pair space is split into square tiles that are each solved with matrix products and written to the
+    # condensed output in the same pair order as calculate_dpa(order=2). Returns (num_pairs,) for a single hypothesis
+    # vector or (num_guesses, num_pairs) for a (num_traces, num_guesses) hypothesis matrix. If pairs = (i, j) index
+    # arrays are given, only those pairs are combined and the output follows their order instead.
+    if combine not in ("abs-diff", "centered-product"):
+        raise ValueError("combine must be either 'abs-diff' or 'centered-product'")
+
+    traces = np.asarray(traces, dtype=np.float64)
+    hypotheses = np.asarray(hypotheses, dtype=np.float64)
+    single_hypothesis = hypotheses.ndim == 1
+    if single_hypothesis:
+        hypotheses = hypotheses.reshape(-1, 1)
+
+    num_traces, length_vector = traces.shape
+    num_guesses = hypotheses.shape[1]
+
+    hws = hypotheses - np.mean(hypotheses, axis=0)
+    o_hws = np.sqrt(np.sum(hws ** 2, axis=0))
+    centered = traces - np.mean(traces, axis=0)
+
+    if pairs is not None:
+        # abs-diff combines the raw samples, the centered product the centered ones
+        samples = traces if combine == "abs-diff" else centered
+        return _second_order_dpa_pairs(samples, hws, o_hws, pairs, combine, memory_budget, single_hypothesis)
+
+    if tile_size is None:
+        # the largest per-tile temporary is (num_traces, tile, tile) for abs-diff and (num_traces, guesses, tile) otherwise.
+        # n_jobs tiles are solved at once, so each gets an equal share of the budget.
+        tile_budget = memory_budget / max(n_jobs, 1)
+        if combine == "abs-diff":
+            tile_size = int(math.sqrt(tile_budget / (16 * num_traces)))
+        else:
+            tile_size = int(tile_budget / (16 * num_traces * num_guesses))
+    tile_size = max(1, min(tile_size, length_vector))
+
+    cpa_output = np.zeros((num_guesses, int((length_vector - 1) * length_vector / 2)))
+    starts = range(0, length_vector, tile_size)
+    tiles = [(a, b) for a in starts for b in starts if b + tile_size > a + 1]
+
+    def solve_tile(tile):
+        a, b = tile
+        i_end = min(a + tile_size, length_vector)
+        j_end = min(b + tile_size, length_vector)
+
+        if combine == "abs-diff":
+            dpa_trace = np.abs(traces[:, a:i_end, None] - traces[:, None, b:j_end]).reshape(num_traces, -1)
+            dpa_trace -= np.mean(dpa_trace, axis=0)
+            o_t = np.sqrt(np.sum(dpa_trace ** 2, axis=0))
+            correlation = hws.T @ dpa_trace
+        else:
+            x_i = centered[:, a:i_end]
+            x_j = centered[:, b:j_end]
+            sum_p = x_i.T @ x_j
+            o_t = np.sqrt(np.maximum((x_i ** 2).T @ (x_j ** 2) - sum_p ** 2 / num_traces, 0)).reshape(-1)
+            weighted = (hws[:, :, None] * x_i[:, None, :]).reshape(num_traces, -1)
+            correlation = (weighted.T @ x_j).reshape(num_guesses, -1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block = (correlation / (o_hws[:, None] * o_t[None, :])).reshape(num_guesses, i_end - a, j_end - b)
+
+        for i in range(a, i_end):
+            j_start = max(b, i + 1)
+            if j_start < j_end:
+                s = pair_index(i, j_start, length_vector)
+                cpa_output[:, s:s + j_end - j_start] = block[:, i - a, j_start - b:]
+
+    if n_jobs > 1:
+        # numpy releases the GIL inside matrix products, so threads share the traces without copying them
+        with ThreadPool(n_jobs) as pool:
+            pool.map(solve_tile, tiles)
+    else:
+        for tile in tiles:
+            solve_tile(tile)
+
+    return cpa_output[0] if single_hypothesis else cpa_output
+
+
+def _second_order_dpa_pairs(samples, hws, o_hws, pairs, combine, memory_budget, single_hypothesis):
+    # combines an explicit list of sample pairs, a chunk of columns at a time
+    i_idx, j_idx = (np.asarray(index, dtype=np.intp) for index in pairs)
+    num_traces = samples.shape[0]
+    chunk_size = max(1, int(memory_budget / (24 * num_traces)))
+
+    cpa_output = np.zeros((hws.shape[1], len(i_idx)))
+    for start in range(0, len(i_idx), chunk_size):
+        x_i = samples[:, i_idx[start:start + chunk_size]]
+        x_j = samples[:, j_idx[start:start + chunk_size]]
+        dpa_trace = np.abs(x_i - x_j) if combine == "abs-diff" else x_i * x_j
+        dpa_trace -= np.mean(dpa_trace, axis=0)
+        o_t = np.sqrt(np.sum(dpa_trace ** 2, axis=0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cpa_output[:, start:start + chunk_size] = (hws.T @ dpa_trace) / (o_hws[:, None] * o_t[None, :])
+
+    return cpa_output[0] if single_hypothesis else cpa_output
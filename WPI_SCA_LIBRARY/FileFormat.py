@@ -1,10 +1,16 @@
 from __future__ import annotations
 
 import json
+import math
 import os
 import re
 import shutil
+import struct
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable, Iterator, MutableMapping
+from contextlib import contextmanager
 from datetime import date
+from functools import lru_cache
 
 import numpy as np
 
@@ -18,21 +24,253 @@ Description: File Format API for side-channel analysis experiments.
 """
 
 
+class LazyDict(MutableMapping):
+    """
+    Dictionary whose values are created on first access. Keys are registered together with a JSON entry, and the loader
+    turns the entry into the actual object the first time the key is read. A loader that returns None marks the key as
+    missing, which removes it from the dictionary. Iterating over the dictionary loads every remaining value.
+    """
+
+    def __init__(self, loader: Callable[[str, dict], any]):
+        """
+        :param loader: A function loader(key, entry) that creates the value of a key from its entry or returns None
+        :type loader: Callable[[str, dict], any]
+        """
+        self._loader = loader
+        self._values = {}
+        self._pending = {}
+
+    def add_lazy(self, key: str, entry: dict) -> None:
+        """
+        Register a key whose value is created from entry on first access.
+        :param key: The key
+        :type key: str
+        :param entry: The JSON entry passed to the loader
+        :type entry: dict
+        :returns: None
+        """
+        self._values[key] = None
+        self._pending[key] = entry
+
+    def __getitem__(self, key: str) -> any:
+        if key in self._pending:
+            value = self._loader(key, self._pending.pop(key))
+            if value is None:
+                del self._values[key]
+                raise KeyError(key)
+            self._values[key] = value
+        return self._values[key]
+
+    def __setitem__(self, key: str, value: any) -> None:
+        self._pending.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        self._pending.pop(key, None)
+        del self._values[key]
+
+    def __iter__(self) -> Iterator[str]:
+        for key in list(self._values):
+            if key in self._values:
+                try:
+                    self[key]
+                except KeyError:
+                    continue
+                yield key
+
+    def __len__(self) -> int:
+        # keys that have not been loaded yet are counted even if the loader would drop them
+        return len(self._values)
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+class MetadataIndex:
+    """
+    Inverted index of the metadata of a group of experiments or datasets. The index maps each metadata key to each of
+    its values and then to the ids of the objects holding that key-value pair, {key: {value: {id: None}}}. The ids of a
+    value are kept as the keys of an insertion-ordered dictionary, stored as {id: null} in JSON, so that adding and
+    removing an id takes constant time even when nearly every object shares the value. Values are stored as their JSON
+    encoding, with booleans, integral floats and numpy scalars normalized so that values equal under == such as 1, 1.0
+    and True are found by the same exact query. The index dictionary lives in the JSON metadata holder, so it is saved
+    and loaded with it. Sorted views of the values of a key are cached in memory for prefix and range queries.
+    """
+
+    def __init__(self, index: dict):
+        """
+        :param index: The index dictionary to maintain. It is updated in place.
+        :type index: dict
+        """
+        self.index = index
+        self._sorted = {}
+
+        # indexes written as {value: [ids]} lists are converted to the {value: {id: None}} form
+        for values in index.values():
+            for encoded, ids in values.items():
+                if isinstance(ids, list):
+                    values[encoded] = dict.fromkeys(ids)
+
+    @classmethod
+    def build(cls, index: dict, objects: Iterable[tuple[str, dict]]) -> 'MetadataIndex':
+        """
+        Builds the index of a group of objects from scratch.
+        :param index: An empty dictionary to hold the index
+        :type index: dict
+        :param objects: The (id, metadata) pair of every object
+        :type objects: Iterable[tuple[str, dict]]
+        :returns: The new index
+        :rtype: MetadataIndex
+        """
+        metadata_index = cls(index)
+        for object_id, metadata in objects:
+            for key, value in metadata.items():
+                metadata_index.add(object_id, key, value)
+        return metadata_index
+
+    def add(self, object_id: str, key: str, value: any) -> None:
+        """
+        Adds the key-value pair of an object to the index.
+        :param object_id: The id of the object
+        :type object_id: str
+        :param key: The metadata key
+        :type key: str
+        :param value: The metadata value. Can be any datatype supported by JSON.
+        :type value: any
+        :returns: None
+        """
+        self.index.setdefault(key, {}).setdefault(_encode_metadata_value(value), {})[object_id] = None
+        self._sorted.pop(key, None)
+
+    def remove(self, object_id: str, key: str, value: any) -> None:
+        """
+        Removes the key-value pair of an object from the index.
+        :param object_id: The id of the object
+        :type object_id: str
+        :param key: The metadata key
+        :type key: str
+        :param value: The metadata value
+        :type value: any
+        :returns: None
+        """
+        values = self.index.get(key, {})
+        encoded = _encode_metadata_value(value)
+        if object_id in values.get(encoded, {}):
+            del values[encoded][object_id]
+            if not values[encoded]:
+                del values[encoded]
+            if not values:
+                del self.index[key]
+        self._sorted.pop(key, None)
+
+    def remove_object(self, object_id: str, metadata: dict) -> None:
+        """
+        Removes all key-value pairs of an object from the index.
+        :param object_id: The id of the object
+        :type object_id: str
+        :param metadata: The metadata of the object
+        :type metadata: dict
+        :returns: None
+        """
+        for key, value in metadata.items():
+            self.remove(object_id, key, value)
+
+    def exact(self, key: str, value: any) -> list[str]:
+        """
+        :returns: The ids of the objects whose metadata maps key to value
+        :rtype: list[str]
+        """
+        return list(self.index.get(key, {}).get(_encode_metadata_value(value), {}))
+
+    def all(self, key: str) -> list[str]:
+        """
+        :returns: The ids of the objects whose metadata contains key
+        :rtype: list[str]
+        """
+        return [object_id for ids in self.index.get(key, {}).values() for object_id in ids]
+
+    def prefix(self, key: str, prefix: str) -> list[str]:
+        """
+        :returns: The ids of the objects whose string value of key starts with prefix
+        :rtype: list[str]
+        """
+        values, encoded = self._sorted_values(key)[1]
+        start = bisect_left(values, prefix)
+        end = start
+        while end < len(values) and values[end].startswith(prefix):
+            end += 1
+        return self._ids(key, encoded[start:end])
+
+    def range(self, key: str, low: any = None, high: any = None) -> list[str]:
+        """
+        :returns: The ids of the objects whose value of key lies in [low, high]. The bounds are either numbers or
+                    strings, and only values of the same kind are matched. A bound of None is unbounded.
+        :rtype: list[str]
+        :raises ValueError: if both bounds are None
+        """
+        if low is None and high is None:
+            raise ValueError("At least one of low and high must be given")
+
+        strings = isinstance(low if low is not None else high, str)
+        values, encoded = self._sorted_values(key)[1 if strings else 0]
+        start = 0 if low is None else bisect_left(values, low)
+        end = len(values) if high is None else bisect_right(values, high)
+        return self._ids(key, encoded[start:end])
+
+    def regex(self, key: str, pattern: str) -> list[str]:
+        """
+        :returns: The ids of the objects whose string value of key matches the regular expression pattern with
+                    `re.match`. Compiled patterns are cached.
+        :rtype: list[str]
+        """
+        compiled = _compile_metadata_pattern(pattern)
+        values, encoded = self._sorted_values(key)[1]
+        return self._ids(key, [enc for value, enc in zip(values, encoded) if compiled.match(value)])
+
+    def _ids(self, key: str, encoded_values: Iterable[str]) -> list[str]:
+        values = self.index.get(key, {})
+        return [object_id for encoded in encoded_values for object_id in values[encoded]]
+
+    def _sorted_values(self, key: str) -> tuple:
+        # ((numbers, encodings), (strings, encodings)) of the distinct values of key, each sorted by value
+        if key not in self._sorted:
+            decoded = [(json.loads(encoded), encoded) for encoded in self.index.get(key, {})]
+            numbers = sorted((value, encoded) for value, encoded in decoded
+                             if isinstance(value, (int, float)) and not isinstance(value, bool))
+            strings = sorted((value, encoded) for value, encoded in decoded if isinstance(value, str))
+            self._sorted[key] = tuple(([value for value, _ in pairs], [encoded for _, encoded in pairs])
+                                      for pairs in (numbers, strings))
+        return self._sorted[key]
+
+
 class FileParent:
-    def __init__(self, name: str, path: str, existing: bool = False):
+    def __init__(self, name: str, path: str, existing: bool = False, compact_json: bool = False):
         """
         Initialize FileFormatParent class. Creates the basic file structure including JSON metadata holder. If the file
         already exists it simply returns a reference to that file. To create a file named "ExampleFile" in your downloads
         directory set the name parameter to `name="ExampleFile` and the path to `path="C:\\users\\username\\\desktop`. The
-        path needs to be structured as shown with double backslashes.
+        path needs to be structured as shown with double backslashes. The experiments and datasets of an
+        existing file are only loaded, and checked for existence on disk, when they are first accessed.
         :param name: The name of the file parent directory
         :type name: str
         :param path: The path to the file parent.
         :type path: str
         :param existing: whether the file already exists
         :type existing: bool
+        :param compact_json: Whether to write the JSON metadata holder without indentation and whitespace. This makes
+                                writes of large files noticeably faster and smaller.
+        :type compact_json: bool
         :returns: None
         """
+        self.compact_json = compact_json
+        self._batch_depth = 0
+        self._json_dirty = False
+        self._metadata_index = None
+
         if not existing:
             self.name = name
             if path[-1:] == "\\":
@@ -67,10 +305,9 @@ class FileParent:
                 "experiments": []
             }
 
-            with open(f"{self.path}\\metadataHolder.json", 'w') as json_file:
-                json.dump(self.json_data, json_file, indent=4)
+            self.update_json()
 
-            self.experiments = {}
+            self.experiments = LazyDict(self._load_experiment)
             self.metadata = self.json_data['metadata']
 
         else:
@@ -92,25 +329,60 @@ class FileParent:
                 self.path = path_from_json
 
             self.experiments_path = f"{self.path}\\Experiments"
-            self.experiments = {}
             self.metadata = self.json_data["metadata"]
 
+            # experiments are only created, and checked for existence, when they are first accessed
+            self.experiments = LazyDict(self._load_experiment)
             for experiment in self.json_data["experiments"]:
-                if os.path.exists(self.path + experiment["path"]):
-                    self.add_experiment_internal(exp_name=experiment.get('name'), existing=True,
-                                                 index=experiment.get('index'),
-                                                 experiment=experiment)
-                else:
-                    for experiment_json in self.json_data["experiments"]:
-                        if experiment_json["name"] == experiment["name"]:
-                            self.json_data["experiments"].remove(experiment_json)
+                self.experiments.add_lazy(sanitize_input(experiment["name"]), experiment)
+
+    def _load_experiment(self, exp_name: str, experiment: dict) -> 'Experiment':
+        if os.path.exists(self.path + experiment["path"]):
+            return Experiment(exp_name, f'\\Experiments\\{exp_name}', self, existing=True,
+                              index=experiment.get('index'), experiment=experiment)
 
-                    with open(f"{self.path}\\metadataHolder.json", 'w') as json_file:
-                        json.dump(self.json_data, json_file, indent=4)
+        self.metadata_index().remove_object(exp_name, experiment["metadata"])
+        for experiment_json in self.json_data["experiments"]:
+            if experiment_json["name"] == experiment["name"]:
+                self.json_data["experiments"].remove(experiment_json)
+
+        self.update_json()
+        return None
 
     def update_json(self) -> None:
-        with open(f"{self.path}\\metadataHolder.json", 'w') as json_file:
-            json.dump(self.json_data, json_file, indent=4)
+        """
+        Write the JSON metadata holder to disk. The file is written to a temporary file first and then renamed over the
+        old one, so it is never left half written. Inside of a `batch()` block the write is deferred until the block ends.
+        :returns: None
+        """
+        if self._batch_depth > 0:
+            self._json_dirty = True
+            return
+
+        json_path = f"{self.path}\\metadataHolder.json"
+        with open(json_path + ".tmp", 'w') as json_file:
+            if self.compact_json:
+                json.dump(self.json_data, json_file, separators=(',', ':'))
+            else:
+                json.dump(self.json_data, json_file, indent=4)
+        os.replace(json_path + ".tmp", json_path)
+        self._json_dirty = False
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Defer all JSON metadata writes made inside of the block to a single write when the outermost block ends, for
+        example `with file.batch(): ...`. Blocks can be nested.
+        :returns: A context manager
+        :rtype: Iterator[None]
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._json_dirty:
+                self.update_json()
 
     def update_metadata(self, key: str, value: any) -> None:
         """
@@ -232,20 +504,50 @@ class FileParent:
         if res == "y" or res == "yes":
             print("Deleting experiment {}".format(experiment_name))
 
-            shutil.rmtree(self.path + self.experiments[experiment_name].path)
-            self.experiments.pop(experiment_name)
+            # load the experiment while its directory still exists, the lazy loader drops missing experiments
+            experiment = self.experiments[experiment_name]
+            shutil.rmtree(self.path + experiment.path)
+            self.metadata_index().remove_object(experiment_name, experiment.metadata)
+            del self.experiments[experiment_name]
             for experiment_json in self.json_data["experiments"]:
                 if experiment_json["name"] == experiment_name:
                     self.json_data["experiments"].remove(experiment_json)
 
-            with open(f"{self.path}\\metadataHolder.json", 'w') as json_file:
-                json.dump(self.json_data, json_file, indent=4)
+            self.update_json()
         else:
             print("Deletion of experiment {} cancelled.".format(experiment_name))
 
+    def metadata_index(self) -> MetadataIndex:
+        """
+        Get the inverted metadata index of the experiments in the FileParent object. Files created before the index
+        existed are indexed on first use.
+        :returns: The metadata index of the experiments
+        :rtype: MetadataIndex
+        """
+        if self._metadata_index is None:
+            if "metadataIndex" in self.json_data:
+                self._metadata_index = MetadataIndex(self.json_data["metadataIndex"])
+            else:
+                self.json_data["metadataIndex"] = {}
+                self._metadata_index = MetadataIndex.build(
+                    self.json_data["metadataIndex"],
+                    ((sanitize_input(experiment["name"]), experiment["metadata"])
+                     for experiment in self.json_data["experiments"]))
+        return self._metadata_index
+
+    def _get_experiments(self, names: list[str]) -> list['Experiment']:
+        experiments = []
+        for name in names:
+            try:
+                experiments.append(self.experiments[name])
+            except KeyError:
+                continue
+        return experiments
+
     def query_experiments_with_metadata(self, key: str, value: any, regex: bool = False) -> list['Experiment']:
         """
         Query all experiments in the FileParent object based on exact metadata key-value pair or using regular expressions.
+        The query is answered from the metadata index and compiled regular expressions are cached.
         :param key: The key to be queried
         :type key: str
         :param value: The value to be queried. Supply a regular expression if the `regex` parameter is set to true. Supplying
@@ -254,20 +556,40 @@ class FileParent:
         :returns: A list of queried experiments
         :rtype: list['Experiment']
         """
-        experiments = []
+        if regex:
+            names = self.metadata_index().regex(key, value)
+        elif value == "*":
+            names = self.metadata_index().all(key)
+        else:
+            names = self.metadata_index().exact(key, value)
+        return self._get_experiments(names)
 
-        for exp in self.experiments.values():
-            try:
-                res = exp.metadata[key]
-                if not regex:
-                    if value == res or value == "*":
-                        experiments.append(exp)
-                else:
-                    if bool(re.match(value, res)):
-                        experiments.append(exp)
-            except KeyError:
-                continue
-        return experiments
+    def query_experiments_with_metadata_prefix(self, key: str, prefix: str) -> list['Experiment']:
+        """
+        Query all experiments in the FileParent object whose string metadata value for a key starts with a prefix.
+        :param key: The key to be queried
+        :type key: str
+        :param prefix: The prefix of the value
+        :type prefix: str
+        :returns: A list of queried experiments
+        :rtype: list['Experiment']
+        """
+        return self._get_experiments(self.metadata_index().prefix(key, prefix))
+
+    def query_experiments_with_metadata_range(self, key: str, low: any = None, high: any = None) -> list['Experiment']:
+        """
+        Query all experiments in the FileParent object whose metadata value for a key lies in the range [low, high].
+        :param key: The key to be queried
+        :type key: str
+        :param low: The lower bound, a number or a string. None for no lower bound.
+        :type low: any
+        :param high: The upper bound, a number or a string. None for no upper bound.
+        :type high: any
+        :returns: A list of queried experiments
+        :rtype: list['Experiment']
+        :raises ValueError: if both bounds are None
+        """
+        return self._get_experiments(self.metadata_index().range(key, low, high))
 
 
 class Experiment:
@@ -282,11 +604,14 @@ class Experiment:
             experiment = {}
 
         name = sanitize_input(name)
+        self._metadata_index = None
+        # the JSON entry is kept by reference, its position in the experiment list changes when experiments are removed
+        self._json_entry = experiment if existing else file_format_parent.json_data["experiments"][index]
 
         if not existing:
             self.name = name
             self.path = path
-            self.dataset = {}
+            self.dataset = LazyDict(self._load_dataset)
             self.metadata = {}
             self.fileFormatParent = file_format_parent
             self.experimentIndex = index
@@ -294,27 +619,33 @@ class Experiment:
         else:
             self.name = name
             self.path = path
-            self.dataset = {}
+            self.dataset = LazyDict(self._load_dataset)
             self.metadata = experiment["metadata"]
             self.fileFormatParent = file_format_parent
             self.experimentIndex = index
 
+            # datasets are only created, and checked for existence, when they are first accessed
             for dataset in experiment["datasets"]:
-                if os.path.exists(self.fileFormatParent.path + self.path + dataset["path"]):
-                    self.add_dataset_internal(dataset["name"], existing=True, dataset=dataset)
-                else:
-                    for experiment_json in self.fileFormatParent.json_data["experiments"]:
-                        if experiment_json["name"] == self.name:
+                self.dataset.add_lazy(sanitize_input(dataset["name"]), dataset)
+
+    def _load_dataset(self, name: str, dataset: dict) -> 'Dataset':
+        if os.path.exists(self.fileFormatParent.path + self.path + dataset["path"]):
+            return Dataset(name, f'\\{name}.npy', self.fileFormatParent, self, dataset["index"], existing=True,
+                           dataset=dataset)
+
+        self.metadata_index().remove_object(name, dataset["metadata"])
+        for experiment_json in self.fileFormatParent.json_data["experiments"]:
+            if experiment_json["name"] == self.name:
 
-                            for _dataset in experiment_json["datasets"]:
-                                if dataset["name"] == _dataset["name"]:
-                                    try:
-                                        experiment_json["datasets"].remove(dataset)
-                                    except ValueError:
-                                        continue
+                for _dataset in experiment_json["datasets"]:
+                    if dataset["name"] == _dataset["name"]:
+                        try:
+                            experiment_json["datasets"].remove(dataset)
+                        except ValueError:
+                            continue
 
-                    with open(f"{self.fileFormatParent.path}\\metadataHolder.json", 'w') as json_file:
-                        json.dump(self.fileFormatParent.json_data, json_file, indent=4)
+        self.fileFormatParent.update_json()
+        return None
 
     def update_metadata(self, key: str, value: any) -> None:
         """
@@ -326,8 +657,11 @@ class Experiment:
         :returns: None
         """
         key = sanitize_input(key)
+        if key in self.metadata:
+            self.fileFormatParent.metadata_index().remove(self.name, key, self.metadata[key])
+        self.fileFormatParent.metadata_index().add(self.name, key, value)
         self.metadata[key] = value
-        self.fileFormatParent.json_data["experiments"][self.experimentIndex]["metadata"][key] = value
+        self._json_entry["metadata"][key] = value
         self.fileFormatParent.update_json()
 
     def read_metadata(self) -> dict:
@@ -354,18 +688,46 @@ class Experiment:
         :returns: The newly created Dataset object
         :rtype: Dataset
         """
-        if partition:
-            num_partitions = len(data_to_add) // trace_per_partition
-            for i in range(num_partitions):
-                partition_data = data_to_add[i * trace_per_partition:(i + 1) * trace_per_partition]
-                partition_name = f"{name}_p{i}"
-                dataset = self.add_dataset_internal(partition_name, existing=False, dataset=None)
-                dataset.add_data(partition_data, datatype)
-            return dataset #return the last dataset
-        else:
+        with self.fileFormatParent.batch():
+            if partition:
+                num_partitions = len(data_to_add) // trace_per_partition
+                for i in range(num_partitions):
+                    partition_data = data_to_add[i * trace_per_partition:(i + 1) * trace_per_partition]
+                    partition_name = f"{name}_p{i}"
+                    dataset = self.add_dataset_internal(partition_name, existing=False, dataset=None)
+                    dataset.add_data(partition_data, datatype)
+                return dataset #return the last dataset
+            else:
+                dataset = self.add_dataset_internal(name, existing=False, dataset=None)
+                dataset.add_data(data_to_add, datatype)
+                return dataset
+
+    def add_appendable_dataset(self, name: str, datatype: any, row_shape: tuple = (), capacity: int = 0) -> 'Dataset':
+        """
+        Adds a new, empty Dataset that grows with `Dataset.append()`. The dataset file is preallocated for `capacity` rows
+        and is grown geometrically once they are used up, so earlier data is never rewritten.
+        :param name: The desired name of the new dataset
+        :type name: str
+        :param datatype: The datatype of the dataset
+        :type datatype: any
+        :param row_shape: The shape of a single row of the dataset, for example (num_samples,) for traces
+        :type row_shape: tuple
+        :param capacity: The number of rows to preallocate
+        :type capacity: int
+        :returns: The newly created Dataset object
+        :rtype: Dataset
+        """
+        with self.fileFormatParent.batch():
             dataset = self.add_dataset_internal(name, existing=False, dataset=None)
-            dataset.add_data(data_to_add, datatype)
-            return dataset
+        dtype = np.dtype(datatype)
+        row_shape = tuple(row_shape)
+
+        with open(dataset.get_data_path(), 'wb') as npy_file:
+            header_size = _npy_header_size(dtype, (0,) + row_shape)
+            npy_file.write(_npy_header((1, 0), header_size, dtype, (0,) + row_shape))
+            npy_file.truncate(header_size + capacity * dtype.itemsize * math.prod(row_shape))
+
+        return dataset
 
     def add_dataset_internal(self, name: str, existing: bool = False, dataset: dict = None) -> 'Dataset':
         """
@@ -394,10 +756,10 @@ class Experiment:
                 "metadata": {}
             }
 
-            self.fileFormatParent.json_data["experiments"][self.experimentIndex]["datasets"].append(dataToAdd)
-            index = len(self.fileFormatParent.json_data["experiments"][self.experimentIndex]["datasets"]) - 1
+            self._json_entry["datasets"].append(dataToAdd)
+            index = len(self._json_entry["datasets"]) - 1
 
-            self.fileFormatParent.json_data["experiments"][self.experimentIndex]["datasets"][index]['index'] = index
+            self._json_entry["datasets"][index]['index'] = index
             self.fileFormatParent.update_json()
 
             self.dataset[name] = Dataset(name, path, self.fileFormatParent, self, index, existing=False)
@@ -475,8 +837,12 @@ class Experiment:
                                                                                                   self.name)))
         if res == "y" or res == "yes":
             print("Deleting dataset {}".format(dataset_name))
+            # load the dataset while its file still exists, the lazy loader drops datasets whose file is missing
+            dataset = self.dataset[dataset_name]
+            dataset.close()
             os.remove(self.fileFormatParent.path + self.path + "\\" + dataset_name + ".npy")
-            self.dataset.pop(dataset_name)
+            self.metadata_index().remove_object(dataset_name, dataset.metadata)
+            del self.dataset[dataset_name]
 
             for experiment_json in self.fileFormatParent.json_data["experiments"]:
                 if experiment_json["name"] == self.name:
@@ -484,15 +850,42 @@ class Experiment:
                         if dataset["name"] == dataset_name:
                             experiment_json["datasets"].remove(dataset)
 
-            with open(f"{self.fileFormatParent.path}\\metadataHolder.json", 'w') as json_file:
-                json.dump(self.fileFormatParent.json_data, json_file, indent=4)
+            self.fileFormatParent.update_json()
 
         else:
             print("Deletion of experiment {} cancelled.".format(dataset_name))
 
+    def metadata_index(self) -> MetadataIndex:
+        """
+        Get the inverted metadata index of the datasets in the Experiment object. Experiments created before the index
+        existed are indexed on first use.
+        :returns: The metadata index of the datasets
+        :rtype: MetadataIndex
+        """
+        if self._metadata_index is None:
+            experiment_json = self._json_entry
+            if "metadataIndex" in experiment_json:
+                self._metadata_index = MetadataIndex(experiment_json["metadataIndex"])
+            else:
+                experiment_json["metadataIndex"] = {}
+                self._metadata_index = MetadataIndex.build(
+                    experiment_json["metadataIndex"],
+                    ((sanitize_input(dataset["name"]), dataset["metadata"]) for dataset in experiment_json["datasets"]))
+        return self._metadata_index
+
+    def _get_datasets(self, names: list[str]) -> list['Dataset']:
+        datasets = []
+        for name in names:
+            try:
+                datasets.append(self.dataset[name])
+            except KeyError:
+                continue
+        return datasets
+
     def query_datasets_with_metadata(self, key: str, value: any, regex: bool = False) -> list['Dataset']:
         """
         Query all datasets in the Experiment object based on exact metadata key-value pair or using regular expressions.
+        The query is answered from the metadata index and compiled regular expressions are cached.
         :param key: The key to be queried
         :type key: str
         :param value: The value to be queried. Supply a regular expression if the `regex` parameter is set to true. Supplying
@@ -501,19 +894,40 @@ class Experiment:
         :returns: A list of queried datasets
         :rtype: list['Dataset']
         """
-        datasets = []
-        for dset in self.dataset.values():
-            try:
-                res = dset.metadata[key]
-                if not regex:
-                    if res == value or value == "*":
-                        datasets.append(dset)
-                else:
-                    if bool(re.match(value, res)):
-                        datasets.append(dset)
-            except KeyError:
-                continue
-        return datasets
+        if regex:
+            names = self.metadata_index().regex(key, value)
+        elif value == "*":
+            names = self.metadata_index().all(key)
+        else:
+            names = self.metadata_index().exact(key, value)
+        return self._get_datasets(names)
+
+    def query_datasets_with_metadata_prefix(self, key: str, prefix: str) -> list['Dataset']:
+        """
+        Query all datasets in the Experiment object whose string metadata value for a key starts with a prefix.
+        :param key: The key to be queried
+        :type key: str
+        :param prefix: The prefix of the value
+        :type prefix: str
+        :returns: A list of queried datasets
+        :rtype: list['Dataset']
+        """
+        return self._get_datasets(self.metadata_index().prefix(key, prefix))
+
+    def query_datasets_with_metadata_range(self, key: str, low: any = None, high: any = None) -> list['Dataset']:
+        """
+        Query all datasets in the Experiment object whose metadata value for a key lies in the range [low, high].
+        :param key: The key to be queried
+        :type key: str
+        :param low: The lower bound, a number or a string. None for no lower bound.
+        :type low: any
+        :param high: The upper bound, a number or a string. None for no upper bound.
+        :type high: any
+        :returns: A list of queried datasets
+        :rtype: list['Dataset']
+        :raises ValueError: if both bounds are None
+        """
+        return self._get_datasets(self.metadata_index().range(key, low, high))
 
     def get_visualization_path(self) -> str:
         """
@@ -573,7 +987,7 @@ class Experiment:
 
         return snr
 
-    def calculate_t_test(self, fixed_dataset: str, random_dataset: str, visualize: bool = False, save_data: bool = False, save_graph: bool = False) -> (np.ndarray, np.ndarray):
+    def calculate_t_test(self, fixed_dataset: str, random_dataset: str, visualize: bool = False, save_data: bool = False, save_graph: bool = False, checkpoints: int | Iterable[int] | str = None) -> (np.ndarray, np.ndarray):
         """
         Integrated t-test metric.
         :param fixed_dataset: The name of the dataset containing the fixed trace set
@@ -586,6 +1000,9 @@ class Experiment:
         :type save_data: bool
         :param save_graph: Whether to save the visualization to the experiments visualization folder or not
         :type save_graph: bool
+        :param checkpoints: The t-max schedule passed to `t_test_tvla`. Either an int stride, an iterable of trace counts
+                            or "log". If set to None, t-max is computed for every trace.
+        :type checkpoints: int | Iterable[int] | str
         :returns: The t-test metric result
         :rtype: np.ndarray
         """
@@ -627,7 +1044,8 @@ class Experiment:
         else:
             path = None
 
-        t, t_max = t_test_tvla(fixed, rand, visualize=visualize, visualization_paths=path)
+        t, t_max = t_test_tvla(fixed, rand, visualize=visualize, visualization_paths=path,
+                               checkpoints=checkpoints)
 
         if save_data:
             self.add_dataset(f"t_test_{random_dataset}_{fixed_dataset}", t, datatype="float32")
@@ -692,15 +1110,14 @@ class Dataset:
             dataset = {}
 
         name = sanitize_input(name)
+        self._append_state = None
         if not existing:
             self.name = name
             self.path = path
             self.index = index
             self.fileFormatParent = file_format_parent
             self.experimentParent = experiment_parent
-            self.metadata = \
-                self.fileFormatParent.json_data["experiments"][self.experimentParent.experimentIndex]["datasets"][
-                    self.index]["metadata"]
+            self.metadata = self.experimentParent._json_entry["datasets"][self.index]["metadata"]
             self.update_metadata("date_created", date.today().strftime('%Y-%m-%d'))
 
         if existing:
@@ -711,19 +1128,47 @@ class Dataset:
             self.experimentParent = experiment_parent
             self.metadata = dataset["metadata"]
 
-    def read_data(self, start: int, end: int) -> np.ndarray:
+    def read_data(self, start: int, end: int, copy: bool = True) -> np.ndarray:
         """
-        Read data from the dataset a specific start and end index.
+        Read data from the dataset a specific start and end index. The dataset file is memory-mapped, so only the
+        requested rows are read from disk.
         :param start: the start index of the data
         :type start: int
         :param end: the end index of the data
         :type end: int
+        :param copy: Whether to return an in-memory copy of the rows or a read-only memory-mapped view of them. A view
+                        costs nothing up front but reads from disk on access and keeps the file open while it is alive.
+        :type copy: bool
         :returns: An NumPy array containing the requested data over the specified interval
         :rtype: np.ndarray
         """
-        data = np.load(self.fileFormatParent.path + self.experimentParent.path + self.path)
+        data = np.load(self.fileFormatParent.path + self.experimentParent.path + self.path, mmap_mode='r')
+        if copy:
+            return np.array(data[start:end])
         return data[start:end]
 
+    def iter_chunks(self, chunk_size: int, copy: bool = True) -> Iterator[np.ndarray]:
+        """
+        Iterate over the dataset in consecutive blocks of rows. The dataset file is memory-mapped, so only one chunk is
+        read from disk at a time.
+        :param chunk_size: The number of rows per chunk. The last chunk may be shorter.
+        :type chunk_size: int
+        :param copy: Whether to yield in-memory copies of the chunks or read-only memory-mapped views of them
+        :type copy: bool
+        :returns: An iterator over the chunks of the dataset
+        :rtype: Iterator[np.ndarray]
+        :raises ValueError: if chunk_size is not positive
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive integer")
+
+        data = np.load(self.fileFormatParent.path + self.experimentParent.path + self.path, mmap_mode='r')
+        for start in range(0, len(data), chunk_size):
+            if copy:
+                yield np.array(data[start:start + chunk_size])
+            else:
+                yield data[start:start + chunk_size]
+
     def read_all(self) -> np.ndarray:
         """
         Read all data from the dataset
@@ -744,8 +1189,117 @@ class Dataset:
         :returns: None
         """
         data_to_add = np.array(data_to_add, dtype=datatype)
+        self.close()
         np.save(self.fileFormatParent.path + self.experimentParent.path + self.path, data_to_add)
 
+    def append(self, batch: np.ndarray) -> None:
+        """
+        Append rows to the end of the dataset without rewriting the rows already stored. The rows are written into a
+        memory-mapped file that is grown geometrically when it is full. Only then is the row count in the file header
+        updated, so readers always see a consistent committed length. Create the dataset with
+        `Experiment.add_appendable_dataset()`. Datasets written by `add_data` can also be appended to if their header has
+        room for the longer shape. The file stays open between calls until `close()` is called.
+        :param batch: The rows to append. A single row may be passed without the leading axis.
+        :type batch: np.ndarray
+        :returns: None
+        :raises ValueError: if the rows do not match the shape of the dataset, or the dataset cannot be grown in place
+        """
+        if self._append_state is None:
+            self._open_append_state()
+        state = self._append_state
+
+        batch = np.asarray(batch, dtype=state["dtype"])
+        if batch.shape == state["row_shape"]:
+            batch = batch.reshape((1,) + batch.shape)
+        if batch.shape[1:] != state["row_shape"]:
+            raise ValueError(f"The rows to append must have shape {state['row_shape']}")
+
+        rows = state["rows"]
+        new_rows = rows + len(batch)
+        if new_rows > state["capacity"]:
+            self._grow_append_state(max(new_rows, 2 * state["capacity"]))
+
+        state["memmap"][rows:new_rows] = batch
+        state["memmap"].flush()
+
+        # commit the new rows by rewriting the shape in the header
+        header = _npy_header(state["version"], state["header_size"], state["dtype"], (new_rows,) + state["row_shape"])
+        state["file"].seek(0)
+        state["file"].write(header)
+        state["file"].flush()
+        state["rows"] = new_rows
+
+    def get_data_path(self) -> str:
+        """
+        Get the path to the .npy file that holds the data of the dataset.
+        :returns: The path to the data file of the dataset
+        :rtype: str
+        """
+        return self.fileFormatParent.path + self.experimentParent.path + self.path
+
+    def _open_append_state(self) -> None:
+        path = self.get_data_path()
+        npy_file = open(path, 'r+b')
+        version = np.lib.format.read_magic(npy_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npy_file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npy_file)
+        header_size = npy_file.tell()
+
+        if fortran_order or len(shape) == 0 or dtype.hasobject:
+            npy_file.close()
+            raise ValueError("Only C-ordered datasets of non-object rows can be appended to")
+
+        row_bytes = dtype.itemsize * math.prod(shape[1:])
+        self._append_state = {
+            "file": npy_file,
+            "version": version,
+            "header_size": header_size,
+            "dtype": dtype,
+            "row_shape": tuple(shape[1:]),
+            "row_bytes": row_bytes,
+            "rows": shape[0],
+            "capacity": (os.path.getsize(path) - header_size) // row_bytes if row_bytes else shape[0],
+            "memmap": None,
+        }
+        self._map_append_state()
+
+    def _map_append_state(self) -> None:
+        state = self._append_state
+        if state["capacity"] > 0 and state["row_bytes"] > 0:
+            state["memmap"] = np.memmap(state["file"], dtype=state["dtype"], mode='r+', offset=state["header_size"],
+                                        shape=(state["capacity"],) + state["row_shape"])
+        else:
+            state["memmap"] = np.empty((0,) + state["row_shape"], dtype=state["dtype"])
+
+    def _grow_append_state(self, capacity: int) -> None:
+        state = self._append_state
+        # the header must be able to hold the largest row count before any rows are written past the old capacity
+        _npy_header(state["version"], state["header_size"], state["dtype"], (capacity,) + state["row_shape"])
+
+        state["memmap"] = None
+        state["file"].truncate(state["header_size"] + capacity * state["row_bytes"])
+        state["capacity"] = capacity
+        self._map_append_state()
+
+    def close(self) -> None:
+        """
+        Release the file handle and memory map held by `append()`. Appending again reopens them. The dataset can also be
+        used as a context manager, `with dataset: dataset.append(batch)`, which closes it on exit.
+        :returns: None
+        """
+        if self._append_state is not None:
+            self._append_state["memmap"] = None
+            self._append_state["file"].close()
+            self._append_state = None
+
+    def __enter__(self) -> 'Dataset':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
     def update_metadata(self, key: str, value: any) -> None:
         """
         Update the dataset metadata using a new key value pair.
@@ -756,10 +1310,61 @@ class Dataset:
         :returns: None
         """
         key = sanitize_input(key)
+        if key in self.metadata:
+            self.experimentParent.metadata_index().remove(self.name, key, self.metadata[key])
+        self.experimentParent.metadata_index().add(self.name, key, value)
         self.metadata[key] = value
         self.fileFormatParent.update_json()
 
 
+def _encode_metadata_value(value: any) -> str:
+    return json.dumps(_normalize_metadata_value(value), sort_keys=True)
+
+
+def _normalize_metadata_value(value: any) -> any:
+    # values that compare equal with == must share an encoding, so numpy scalars are converted to Python values and
+    # booleans and integral floats are stored as ints
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalize_metadata_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _normalize_metadata_value(item) for key, item in value.items()}
+    return value
+
+
+@lru_cache(maxsize=256)
+def _compile_metadata_pattern(pattern: str) -> re.Pattern:
+    return re.compile(pattern)
+
+
+def _npy_header_size(dtype: np.dtype, shape: tuple) -> int:
+    # room for the header of the given shape plus 21 more digits of growth in the row count, aligned to 64 bytes
+    header = _npy_header_string(dtype, shape)
+    return (10 + len(header) + 21 + 1 + 63) // 64 * 64
+
+
+def _npy_header_string(dtype: np.dtype, shape: tuple) -> str:
+    return repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": tuple(shape)})
+
+
+def _npy_header(version: tuple, header_size: int, dtype: np.dtype, shape: tuple) -> bytes:
+    # .npy header padded with spaces to exactly header_size bytes, so it can be rewritten in place as the shape grows
+    prefix_size = 10 if version == (1, 0) else 12
+    header = _npy_header_string(dtype, shape)
+    if len(header) + 1 > header_size - prefix_size:
+        raise ValueError("The dataset header has no room for the new shape. Re-create the dataset with "
+                         "Experiment.add_appendable_dataset()")
+
+    header = header.ljust(header_size - prefix_size - 1) + "\n"
+    length = struct.pack('<H' if version == (1, 0) else '<I', len(header))
+    return np.lib.format.magic(*version) + length + header.encode('latin1')
+
+
 def sanitize_input(input_string: str) -> str:
     if type(input_string) is not str:
         raise ValueError("The input to this function must be of type string")
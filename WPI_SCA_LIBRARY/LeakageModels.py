@@ -1,5 +1,10 @@
 from __future__ import annotations
 
+import hashlib
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from functools import partial
+
 import numpy as np
 
 
@@ -9,22 +14,18 @@ def leakage_model_hamming_weight(num_traces: int, plaintexts: list | np.ndarray,
 
     :param num_traces: The number of traces collected when measuring the observed leakage
     :type num_traces: int
-    :param plaintexts: The array of plaintexts used to collect the observed leakage
+    :param plaintexts: The array of plaintexts used to collect the observed leakage. Either the full (n_traces, 16)
+                        plaintext array or the column of the target byte.
     :type plaintexts: list | np.ndarray
-    :param subkey_guess: the subkey guess
+    :param subkey_guess: the subkey guess, or an array of subkey guesses to generate one column per guess
     :type subkey_guess: any
     :param target_byte: the target byte of the key
     :type target_byte: int
-    :return: numpy array of the hypothetical leakage
+    :return: uint8 numpy array of the hypothetical leakage with shape (num_traces,) or (num_traces, n_guesses)
     :rtype: np.ndarray
     :Authors: Samuel Karkache (swkarkche@wpi.edu)
     """
-    leakage = np.empty(num_traces, dtype=object)
-
-    for i in range(num_traces):
-        leakage[i] = bin(Sbox[subkey_guess ^ plaintexts[i][target_byte]]).count('1')
-
-    return leakage
+    return HammingWeight[sbox_output(num_traces, plaintexts, subkey_guess, target_byte)]
 
 
 def leakage_model_hamming_distance(num_traces: int, plaintexts: list | np.ndarray, subkey_guess: any, target_byte: int) -> np.ndarray:
@@ -34,22 +35,423 @@ def leakage_model_hamming_distance(num_traces: int, plaintexts: list | np.ndarra
 
     :param num_traces: The number of traces collected when measuring the observed leakage
     :type num_traces: int
-    :param plaintexts: The array of plaintexts used to collect the observed leakage
+    :param plaintexts: The array of plaintexts used to collect the observed leakage. Either the full (n_traces, 16)
+                        plaintext array or the column of the target byte.
     :type plaintexts: list | np.ndarray
-    :param subkey_guess: the subkey guess
+    :param subkey_guess: the subkey guess, or an array of subkey guesses to generate one column per guess
     :type subkey_guess: any
     :param target_byte: the target byte of the key
     :type target_byte: int
-    :return: numpy array of the hypothetical leakage
+    :return: uint8 numpy array of the hypothetical leakage with shape (num_traces,) or (num_traces, n_guesses)
     :rtype: np.ndarray
     :Authors: Samuel Karkache (swkarkache@wpi.edu)
     """
-    leakage = np.empty(num_traces, dtype=object)
+    return HammingWeight[Sbox[0] ^ sbox_output(num_traces, plaintexts, subkey_guess, target_byte)]
 
-    for i in range(num_traces):
-        leakage[i] = bin(Sbox[0] ^ Sbox[subkey_guess ^ plaintexts[i][target_byte]]).count('1')
 
-    return leakage
+def sbox_input(num_traces: int, plaintexts: list | np.ndarray, subkey_guess: any, target_byte: int) -> np.ndarray:
+    """
+    Computes the first round AES sbox input, plaintext ^ subkey_guess, of the target byte for every trace.
+
+    :param num_traces: The number of traces
+    :type num_traces: int
+    :param plaintexts: Either the full (n_traces, 16) plaintext array or the column of the target byte
+    :type plaintexts: list | np.ndarray
+    :param subkey_guess: the subkey guess, or an array of subkey guesses to generate one column per guess
+    :type subkey_guess: any
+    :param target_byte: the target byte of the key. Ignored if plaintexts is a single column.
+    :type target_byte: int
+    :return: uint8 numpy array of sbox inputs with shape (num_traces,) or (num_traces, n_guesses)
+    :rtype: np.ndarray
+    """
+    plaintexts = np.asarray(plaintexts)
+    if plaintexts.ndim > 1:
+        plaintexts = plaintexts[:num_traces, target_byte]
+    else:
+        plaintexts = plaintexts[:num_traces]
+    plaintexts = plaintexts.astype(np.uint8)
+
+    subkey_guess = np.asarray(subkey_guess).astype(np.uint8)
+    if subkey_guess.ndim > 0:
+        plaintexts = plaintexts[:, None]
+        subkey_guess = subkey_guess[None, :]
+
+    return plaintexts ^ subkey_guess
+
+
+def sbox_output(num_traces: int, plaintexts: list | np.ndarray, subkey_guess: any, target_byte: int) -> np.ndarray:
+    """
+    Computes the first round AES sbox output of the target byte for every trace.
+
+    :param num_traces: The number of traces
+    :type num_traces: int
+    :param plaintexts: Either the full (n_traces, 16) plaintext array or the column of the target byte
+    :type plaintexts: list | np.ndarray
+    :param subkey_guess: the subkey guess, or an array of subkey guesses to generate one column per guess
+    :type subkey_guess: any
+    :param target_byte: the target byte of the key. Ignored if plaintexts is a single column.
+    :type target_byte: int
+    :return: uint8 numpy array of sbox outputs with shape (num_traces,) or (num_traces, n_guesses)
+    :rtype: np.ndarray
+    """
+    return Sbox[sbox_input(num_traces, plaintexts, subkey_guess, target_byte)]
+
+
+def leakage_model_identity(num_traces: int, plaintexts: list | np.ndarray, subkey_guess: any, target_byte: int) -> np.ndarray:
+    """
+    Generates hypothetical leakage equal to the value of the AES sbox output.
+
+    :param num_traces: The number of traces collected when measuring the observed leakage
+    :type num_traces: int
+    :param plaintexts: The array of plaintexts used to collect the observed leakage. Either the full (n_traces, 16)
+                        plaintext array or the column of the target byte.
+    :type plaintexts: list | np.ndarray
+    :param subkey_guess: the subkey guess, or an array of subkey guesses to generate one column per guess
+    :type subkey_guess: any
+    :param target_byte: the target byte of the key
+    :type target_byte: int
+    :return: uint8 numpy array of the hypothetical leakage with shape (num_traces,) or (num_traces, n_guesses)
+    :rtype: np.ndarray
+    """
+    return sbox_output(num_traces, plaintexts, subkey_guess, target_byte)
+
+
+def leakage_model_single_bit(num_traces: int, plaintexts: list | np.ndarray, subkey_guess: any, target_byte: int,
+                             bit: int = 0) -> np.ndarray:
+    """
+    Generates hypothetical leakage equal to a single bit of the AES sbox output.
+
+    :param num_traces: The number of traces collected when measuring the observed leakage
+    :type num_traces: int
+    :param plaintexts: The array of plaintexts used to collect the observed leakage. Either the full (n_traces, 16)
+                        plaintext array or the column of the target byte.
+    :type plaintexts: list | np.ndarray
+    :param subkey_guess: the subkey guess, or an array of subkey guesses to generate one column per guess
+    :type subkey_guess: any
+    :param target_byte: the target byte of the key
+    :type target_byte: int
+    :param bit: the sbox output bit, where 0 is the least significant bit
+    :type bit: int
+    :return: uint8 numpy array of the hypothetical leakage with shape (num_traces,) or (num_traces, n_guesses)
+    :rtype: np.ndarray
+    """
+    return (sbox_output(num_traces, plaintexts, subkey_guess, target_byte) >> bit) & 1
+
+
+def leakage_model_hamming_distance_sbox_input(num_traces: int, plaintexts: list | np.ndarray, subkey_guess: any,
+                                              target_byte: int) -> np.ndarray:
+    """
+    Generates hypothetical leakage using the hamming distance between the previous state, the sbox input
+    plaintext ^ subkey_guess, and the sbox output that overwrites it.
+
+    :param num_traces: The number of traces collected when measuring the observed leakage
+    :type num_traces: int
+    :param plaintexts: The array of plaintexts used to collect the observed leakage. Either the full (n_traces, 16)
+                        plaintext array or the column of the target byte.
+    :type plaintexts: list | np.ndarray
+    :param subkey_guess: the subkey guess, or an array of subkey guesses to generate one column per guess
+    :type subkey_guess: any
+    :param target_byte: the target byte of the key
+    :type target_byte: int
+    :return: uint8 numpy array of the hypothetical leakage with shape (num_traces,) or (num_traces, n_guesses)
+    :rtype: np.ndarray
+    """
+    state = sbox_input(num_traces, plaintexts, subkey_guess, target_byte)
+    return HammingWeight[state ^ Sbox[state]]
+
+
+def leakage_model_last_round_hamming_weight(num_traces: int, ciphertexts: np.ndarray, subkey_guess: any,
+                                            target_byte: int) -> np.ndarray:
+    """
+    Generates hypothetical leakage based on the hamming weight of the AES state before the last round, recovered from the
+    ciphertexts with the inverse sbox. The subkey guess is a byte of the last round key.
+
+    :param num_traces: The number of traces collected when measuring the observed leakage
+    :type num_traces: int
+    :param ciphertexts: The (n_traces, 16) array of ciphertexts, or the column of the target byte
+    :type ciphertexts: np.ndarray
+    :param subkey_guess: the last round subkey guess, or an array of subkey guesses to generate one column per guess
+    :type subkey_guess: any
+    :param target_byte: the target byte of the last round key
+    :type target_byte: int
+    :return: uint8 numpy array of the hypothetical leakage with shape (num_traces,) or (num_traces, n_guesses)
+    :rtype: np.ndarray
+    """
+    return HammingWeight[InvSbox[sbox_input(num_traces, ciphertexts, subkey_guess, target_byte)]]
+
+
+def leakage_model_last_round_hamming_distance(num_traces: int, ciphertexts: np.ndarray, subkey_guess: any,
+                                              target_byte: int) -> np.ndarray:
+    """
+    Generates hypothetical leakage using the hamming distance between the AES state before the last round and the
+    ciphertext that overwrites it in the same state register. The state byte InvSbox[c[target_byte] ^ k] is held in the
+    register at position ShiftRows[target_byte], which holds c[ShiftRows[target_byte]] after the last round. The subkey
+    guess is a byte of the last round key.
+
+    :param num_traces: The number of traces collected when measuring the observed leakage
+    :type num_traces: int
+    :param ciphertexts: The (n_traces, 16) array of ciphertexts
+    :type ciphertexts: np.ndarray
+    :param subkey_guess: the last round subkey guess, or an array of subkey guesses to generate one column per guess
+    :type subkey_guess: any
+    :param target_byte: the target byte of the last round key
+    :type target_byte: int
+    :return: uint8 numpy array of the hypothetical leakage with shape (num_traces,) or (num_traces, n_guesses)
+    :rtype: np.ndarray
+    """
+    ciphertexts = np.asarray(ciphertexts)
+    state = InvSbox[sbox_input(num_traces, ciphertexts, subkey_guess, target_byte)]
+
+    register = ciphertexts[:num_traces, ShiftRows[target_byte]].astype(np.uint8)
+    if state.ndim > 1:
+        register = register[:, None]
+
+    return HammingWeight[state ^ register]
+
+
+def sbox_output_bits(plaintexts: np.ndarray, target_byte: int, key_candidates: Iterable = range(256)) -> np.ndarray:
+    """
+    Decomposes the AES sbox output of every key candidate into its 8 bits for every trace.
+
+    :param plaintexts: Either the full (n_traces, 16) plaintext array or the column of the target byte
+    :type plaintexts: np.ndarray
+    :param target_byte: the target byte of the key
+    :type target_byte: int
+    :param key_candidates: The key candidates
+    :type key_candidates: Iterable
+    :return: uint8 numpy array of bits with shape (n_traces, n_candidates, 8), where bit 0 is the least significant bit
+    :rtype: np.ndarray
+    """
+    key_candidates = np.array(list(key_candidates))
+    outputs = sbox_output(len(plaintexts), plaintexts, key_candidates, target_byte)
+    return np.unpackbits(outputs[:, :, None], axis=2, bitorder='little')
+
+
+def hypothesis_tensor(plaintexts: np.ndarray, leakage_model: Callable = leakage_model_hamming_weight,
+                      key_candidates: Iterable = range(256), target_bytes: Iterable[int] = range(16),
+                      dtype: any = np.uint8, output_path: str = None, chunk_size: int = 65536) -> np.ndarray:
+    """
+    Generates the hypothetical leakage of every key candidate for every target byte in one vectorized pass. Models that
+    only depend on the target byte, such as the first round models in this module, are first evaluated for all 256 byte
+    values, e.g. HammingWeight[Sbox[pt[:, None] ^ k[None, :]]] for the hamming weight model, and the tensor is then
+    filled by indexing that table with each plaintext column. Other models, such as the last round hamming distance
+    model, are evaluated directly for all key candidates in chunks of traces.
+
+    :param plaintexts: The (n_traces, 16) array of plaintexts, or ciphertexts for the last round models, used to collect
+                        the observed leakage
+    :type plaintexts: np.ndarray
+    :param leakage_model: A leakage model that accepts an array of subkey guesses, such as the models in this module
+    :type leakage_model: Callable
+    :param key_candidates: The key candidates
+    :type key_candidates: Iterable
+    :param target_bytes: The target bytes of the key
+    :type target_bytes: Iterable[int]
+    :param dtype: The datatype of the tensor. The default uint8 keeps the tensor compact.
+    :type dtype: any
+    :param output_path: If supplied, the tensor is written to a memory-mapped .npy file at this path instead of being
+                        held in memory
+    :type output_path: str
+    :param chunk_size: The number of traces evaluated at once by models that are not table based
+    :type chunk_size: int
+    :return: The hypothesis tensor with shape (n_target_bytes, n_candidates, n_traces)
+    :rtype: np.ndarray
+    """
+    plaintexts = np.asarray(plaintexts)
+    key_candidates = np.array(list(key_candidates))
+    target_bytes = list(target_bytes)
+    num_traces = len(plaintexts)
+    shape = (len(target_bytes), len(key_candidates), num_traces)
+
+    if output_path is not None:
+        tensor = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=shape)
+    else:
+        tensor = np.empty(shape, dtype=dtype)
+
+    byte_values = np.arange(256, dtype=np.uint8)
+    byte_local = any(leakage_model is model for model in byte_local_leakage_models)
+
+    for i, target_byte in enumerate(target_bytes):
+        if byte_local:
+            # (n_candidates, 256) table of the leakage of every key candidate and plaintext byte value
+            table = np.ascontiguousarray(np.asarray(leakage_model(256, byte_values, key_candidates, target_byte),
+                                                    dtype=dtype).T)
+            np.take(table, plaintexts[:, target_byte].astype(np.intp), axis=1, out=tensor[i])
+        else:
+            for start in range(0, num_traces, chunk_size):
+                end = min(start + chunk_size, num_traces)
+                tensor[i, :, start:end] = leakage_model(end - start, plaintexts[start:end], key_candidates, target_byte).T
+
+    if output_path is not None:
+        tensor.flush()
+
+    return tensor
+
+
+class HypothesisCache:
+    """
+    Least recently used cache of hypothesis matrices bounded by a total byte budget. Cached matrices are read-only.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        """
+        :param max_bytes: The maximum total size of the cached matrices in bytes
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key: tuple) -> np.ndarray | None:
+        """
+        Look up a cached hypothesis matrix and mark it as most recently used.
+        :param key: The cache key
+        :type key: tuple
+        :return: The cached matrix or None if it is not cached
+        :rtype: np.ndarray | None
+        """
+        matrix = self.entries.get(key)
+        if matrix is not None:
+            self.entries.move_to_end(key)
+        return matrix
+
+    def put(self, key: tuple, matrix: np.ndarray) -> None:
+        """
+        Cache a hypothesis matrix, evicting the least recently used matrices until it fits in the byte budget. Matrices
+        larger than the whole budget are not cached.
+        :param key: The cache key
+        :type key: tuple
+        :param matrix: The hypothesis matrix
+        :type matrix: np.ndarray
+        :return: None
+        """
+        if matrix.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.current_bytes -= self.entries.pop(key).nbytes
+
+        while self.current_bytes + matrix.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+
+        matrix.setflags(write=False)
+        self.entries[key] = matrix
+        self.current_bytes += matrix.nbytes
+
+    def clear(self) -> None:
+        """
+        Remove all cached matrices.
+        :return: None
+        """
+        self.entries.clear()
+        self.current_bytes = 0
+
+
+# cache shared by all hypothesis_matrix calls that do not supply their own
+hypothesis_cache = HypothesisCache()
+
+# registry of named leakage models, all of which accept an array of subkey guesses
+leakage_models = {}
+
+
+def register_leakage_model(name: str, leakage_model: Callable) -> None:
+    """
+    Registers a leakage model under a name so that it can be passed by name to `hypothesis_matrix` and the scoring
+    functions. Registered models must be in the form leakage_model(num_traces, plaintexts, subkey_guess, target_byte) and
+    must accept an array of subkey guesses, returning one column per guess.
+
+    :param name: The name of the leakage model
+    :type name: str
+    :param leakage_model: The leakage model function
+    :type leakage_model: Callable
+    :return: None
+    """
+    leakage_models[name] = leakage_model
+
+
+def get_leakage_model(name: str) -> Callable:
+    """
+    Looks up a registered leakage model.
+
+    :param name: The name of the leakage model
+    :type name: str
+    :return: The leakage model function
+    :rtype: Callable
+    :raises ValueError: if no leakage model is registered under the name
+    """
+    try:
+        return leakage_models[name]
+    except KeyError:
+        raise ValueError(f"Unknown leakage model: {name}") from None
+
+
+def hypothesis_matrix(leakage_model: str | Callable, plaintexts: np.ndarray, target_byte: int,
+                      key_candidates: Iterable = range(256), cache: HypothesisCache | None = hypothesis_cache) -> np.ndarray:
+    """
+    Generates the hypothesis matrix of a leakage model for a set of key candidates. Matrices are cached keyed on the
+    leakage model, a hash of the plaintexts, the target byte and the key candidates, so repeated attacks on the same
+    plaintexts do not regenerate them. Registered leakage models are evaluated for all key candidates in one call, any
+    other callable is called once per key candidate.
+
+    :param leakage_model: The name of a registered leakage model or a leakage model function
+    :type leakage_model: str | Callable
+    :param plaintexts: The plaintexts used during trace capture
+    :type plaintexts: np.ndarray
+    :param target_byte: The target byte of the key
+    :type target_byte: int
+    :param key_candidates: The key candidates, one column of the matrix each
+    :type key_candidates: Iterable
+    :param cache: The cache to use. Set to None to disable caching.
+    :type cache: HypothesisCache | None
+    :return: The hypothetical leakage with shape (n_traces, n_candidates). Read-only if it was cached.
+    :rtype: np.ndarray
+    :raises ValueError: if leakage_model is the name of an unregistered leakage model
+    """
+    if isinstance(leakage_model, str):
+        leakage_model = get_leakage_model(leakage_model)
+
+    plaintexts = np.asarray(plaintexts)
+    key_candidates = np.array(list(key_candidates))
+    num_traces = len(plaintexts)
+
+    if cache is not None:
+        key = (leakage_model, _array_digest(plaintexts), target_byte, _array_digest(key_candidates))
+        matrix = cache.get(key)
+        if matrix is not None:
+            return matrix
+
+    if any(leakage_model is model for model in leakage_models.values()):
+        matrix = np.asarray(leakage_model(num_traces, plaintexts, key_candidates, target_byte))
+    else:
+        matrix = np.column_stack([np.asarray(leakage_model(num_traces, plaintexts, k, target_byte))
+                                  for k in key_candidates])
+
+    if cache is not None:
+        cache.put(key, matrix)
+
+    return matrix
+
+
+def _array_digest(array: np.ndarray) -> tuple:
+    """
+    Hashes the contents, shape and datatype of an array for use in cache keys. Not intended to be called outside this
+    module.
+    """
+    array = np.ascontiguousarray(array)
+    return array.shape, array.dtype.str, hashlib.blake2b(array.data, digest_size=16).hexdigest()
+
+
+register_leakage_model("hamming_weight", leakage_model_hamming_weight)
+register_leakage_model("hamming_distance", leakage_model_hamming_distance)
+register_leakage_model("hamming_distance_sbox_input", leakage_model_hamming_distance_sbox_input)
+register_leakage_model("identity", leakage_model_identity)
+register_leakage_model("last_round_hamming_weight", leakage_model_last_round_hamming_weight)
+register_leakage_model("last_round_hamming_distance", leakage_model_last_round_hamming_distance)
+for _bit in range(8):
+    register_leakage_model(f"bit{_bit}", partial(leakage_model_single_bit, bit=_bit))
+
+# registered models whose leakage only depends on the target byte of their input, which hypothesis_tensor evaluates
+# with a 256 entry table per key candidate
+byte_local_leakage_models = [model for name, model in leakage_models.items() if name != "last_round_hamming_distance"]
 
 
 # AES 128 Sbox LUT
@@ -70,4 +472,13 @@ Sbox = np.array([
     0x70, 0x3E, 0xB5, 0x66, 0x48, 0x03, 0xF6, 0x0E, 0x61, 0x35, 0x57, 0xB9, 0x86, 0xC1, 0x1D, 0x9E,
     0xE1, 0xF8, 0x98, 0x11, 0x69, 0xD9, 0x8E, 0x94, 0x9B, 0x1E, 0x87, 0xE9, 0xCE, 0x55, 0x28, 0xDF,
     0x8C, 0xA1, 0x89, 0x0D, 0xBF, 0xE6, 0x42, 0x68, 0x41, 0x99, 0x2D, 0x0F, 0xB0, 0x54, 0xBB, 0x16
-])
+], dtype=np.uint8)
+
+# Hamming weight (popcount) LUT of all byte values
+HammingWeight = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+# AES 128 inverse Sbox LUT
+InvSbox = np.argsort(Sbox).astype(np.uint8)
+
+# ShiftRows[i] is the state position whose byte is moved to position i by ShiftRows (column-major state)
+ShiftRows = np.array([0, 5, 10, 15, 4, 9, 14, 3, 8, 13, 2, 7, 12, 1, 6, 11])
@@ -13,11 +13,14 @@ import matplotlib.pyplot as plt
 from tqdm import *
 from collections.abc import *
 from numbers import Number
+from statistics import NormalDist
 import multiprocessing as mp
-from WPI_SCA_LIBRARY.LeakageModels import Sbox
+from multiprocessing import shared_memory, util
+from WPI_SCA_LIBRARY.LeakageModels import Sbox, get_leakage_model, hypothesis_cache, hypothesis_matrix
 
 
-def signal_to_noise_ratio(labels: dict, visualize: bool = False, visualization_path: any = None) -> np.ndarray:
+def signal_to_noise_ratio(labels: dict, visualize: bool = False, visualization_path: any = None,
+                          traces: np.ndarray = None) -> np.ndarray:
     """
     Computes the signal-to-noise ratio of a trace set and associated labels. High magnitudes of the resulting SNR traces
     indicate cryptographic leakage at that sample.
@@ -30,25 +33,31 @@ def signal_to_noise_ratio(labels: dict, visualize: bool = False, visualization_p
     :type visualize: bool
     :param visualization_path: The path of where to save the visualization result, does not save if set to None
     :type visualization_path: any
+    :param traces: The trace set indexed by the labels dictionary returned by `organize_snr_label(mode="indices")`. If
+                    supplied, labels[L] holds the indices of the traces associated with label L instead of the traces.
+    :type traces: np.ndarray
     :return: The SNR of the provided trace set
     :rtype: np.ndarray
     :raises TypeError: if any value in labels.items() is not a np.ndarray or list type
+    :raises ValueError: if labels holds index arrays but traces is not supplied
     :Authors: Samuel Karkache (swkarkache@wpi.edu), Trey Marcantonio (tmmarcantonio@wpi.edu)
     """
 
     label_set = labels.values()
-    label_set_size = len(label_set)
-    set_means = np.empty(label_set_size, dtype=object)
-    set_var = np.empty(label_set_size, dtype=object)
+    accumulator = StreamingSNR(len(label_set))
 
     for i, trace_set in enumerate(tqdm(label_set, desc="Computing Signal-To-Noise Ratio")):
         if isinstance(trace_set, np.ndarray) or isinstance(trace_set, list):
-            set_means[i] = np.mean(trace_set, axis=0)
-            set_var[i] = np.var(trace_set, axis=0)
+            trace_set = np.asarray(trace_set)
+            if traces is not None:
+                trace_set = np.asarray(traces)[trace_set]
+            elif trace_set.ndim == 1 and np.issubdtype(trace_set.dtype, np.integer):
+                raise ValueError("labels holds index arrays, pass the trace set they index with the traces parameter")
+            accumulator.update(trace_set, np.full(len(trace_set), i))
         else:
             raise TypeError("All items of the labels dict must be a list or numpy array")
 
-    snr = np.divide(np.var(set_means, axis=0), np.mean(set_var, axis=0))
+    snr = accumulator.snr()
 
     if visualize:
         plt.plot(snr)
@@ -63,7 +72,106 @@ def signal_to_noise_ratio(labels: dict, visualize: bool = False, visualization_p
     return snr
 
 
-def organize_snr_label(traces: np.ndarray, intermediate_fcn: Callable, *args: any) -> dict:
+class StreamingSNR:
+    """
+    One-pass signal-to-noise ratio accumulator. Keeps the per-label count, sum and sum of squares of the traces in
+    preallocated float64 arrays of shape (n_labels, n_samples) so that the SNR of an arbitrarily large trace set can be
+    computed batch by batch without holding any of the traces in memory.
+    """
+
+    def __init__(self, n_labels: int = 256, n_samples: int = None):
+        """
+        :param n_labels: The number of possible labels. Labels passed to `update` must be integers in [0, n_labels).
+        :type n_labels: int
+        :param n_samples: The number of samples per trace. Inferred from the first batch if set to None.
+        :type n_samples: int
+        """
+        self.n_labels = n_labels
+        self.n_samples = None
+        self.counts = np.zeros(n_labels, dtype=np.int64)
+        self.sums = None
+        self.sums_squared = None
+        self._shift = None
+
+        if n_samples is not None:
+            self._allocate(n_samples)
+
+    def _allocate(self, n_samples: int) -> None:
+        self.n_samples = n_samples
+        self.sums = np.zeros((self.n_labels, n_samples), dtype=np.float64)
+        self.sums_squared = np.zeros((self.n_labels, n_samples), dtype=np.float64)
+
+    def update(self, traces: np.ndarray, labels: np.ndarray) -> None:
+        """
+        Adds a batch of traces and their associated labels to the accumulator.
+        :param traces: The batch of traces with shape (n_traces, n_samples)
+        :type traces: np.ndarray
+        :param labels: The integer label of each trace with shape (n_traces,)
+        :type labels: np.ndarray
+        :returns: None
+        :raises ValueError: if the number of traces and labels differ or a label is outside of [0, n_labels)
+        """
+        traces = np.asarray(traces, dtype=np.float64)
+        labels = np.asarray(labels, dtype=np.int64).ravel()
+
+        if traces.ndim == 1:
+            traces = traces.reshape(1, -1)
+        if len(traces) != len(labels):
+            raise ValueError("The number of traces and labels must be equal")
+        if len(labels) == 0:
+            return
+        if labels.min() < 0 or labels.max() >= self.n_labels:
+            raise ValueError("Labels must be integers in the range [0, n_labels)")
+
+        if self.sums is None:
+            self._allocate(traces.shape[1])
+
+        # accumulate around the mean of the first batch to limit cancellation in the sum of squares
+        if self._shift is None:
+            self._shift = np.mean(traces, axis=0)
+        centered = traces - self._shift
+
+        unique_labels, order, starts = group_by_label(labels)
+        centered = centered[order]
+
+        self.sums[unique_labels] += np.add.reduceat(centered, starts, axis=0)
+        self.sums_squared[unique_labels] += np.add.reduceat(np.square(centered), starts, axis=0)
+        self.counts += np.bincount(labels, minlength=self.n_labels)
+
+    def snr(self) -> np.ndarray:
+        """
+        Computes the signal-to-noise ratio of all traces accumulated so far. Labels that have not been seen are ignored.
+        :returns: The SNR at each time sample
+        :rtype: np.ndarray
+        """
+        seen = self.counts > 0
+        counts = self.counts[seen].reshape(-1, 1)
+        means = self.sums[seen] / counts
+        variances = self.sums_squared[seen] / counts - np.square(means)
+
+        return np.divide(np.var(means, axis=0), np.mean(variances, axis=0))
+
+
+def group_by_label(labels: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Groups trace indices by label using a single stable argsort.
+    :param labels: The label of each trace
+    :type labels: np.ndarray
+    :return: The unique labels, the argsort order of the labels, and the start offset of each label's group within
+                that order. The indices of the traces with label unique_labels[i] are order[starts[i]:starts[i + 1]].
+    :rtype: (np.ndarray, np.ndarray, np.ndarray)
+    """
+    labels = np.asarray(labels).ravel()
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+
+    boundaries = np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1]) + 1
+    starts = np.concatenate(([0], boundaries)) if len(labels) > 0 else np.empty(0, dtype=np.intp)
+
+    return sorted_labels[starts], order, starts
+
+
+def organize_snr_label(traces: np.ndarray, intermediate_fcn: Callable, *args: any, mode: str = "traces") -> dict:
     """
     Organizes label dictionary for SNR metric
     :param traces: The trace set to be used in label organization
@@ -71,21 +179,28 @@ def organize_snr_label(traces: np.ndarray, intermediate_fcn: Callable, *args: an
     :param intermediate_fcn: A callback function used to generate np array of possible labels
     :type intermediate_fcn: Callable
     :param args: Additional arguments needed for intermediate_func
+    :param mode: "traces" maps each label to a contiguous array of its traces. All of these arrays are views into a single
+                    label-sorted copy of the trace set. "indices" maps each label to the indices of its traces instead and
+                    does not copy any trace data. Pass the trace set to `signal_to_noise_ratio` with its traces parameter
+                    when using the "indices" mode.
+    :type mode: str
     :return: The labels dictionary organized
     :rtype: dict
+    :raises ValueError: if mode is not "traces" or "indices"
     :Authors: Samuel Karkache (swkarkache@wpi.edu), Trey Marcantonio (tmmarcantonio@wpi.edu)
     """
-    intermediate_values = intermediate_fcn(*args)
-    labelsUnique = np.unique(intermediate_values)
+    if mode not in ("traces", "indices"):
+        raise ValueError("mode must be either 'traces' or 'indices'")
 
-    sorted_labels = {}
-    for i in labelsUnique:
-        sorted_labels[i] = []
+    intermediate_values = intermediate_fcn(*args)
+    unique_labels, order, starts = group_by_label(intermediate_values)
+    ends = np.append(starts[1:], len(order))
 
-    for index, label in enumerate(intermediate_values):
-        sorted_labels[label].append(np.array(traces[index]))
+    if mode == "indices":
+        return {label: order[start:end] for label, start, end in zip(unique_labels, starts, ends)}
 
-    return sorted_labels
+    sorted_traces = np.asarray(traces)[order]
+    return {label: sorted_traces[start:end] for label, start, end in zip(unique_labels, starts, ends)}
 
 
 def unmasked_sbox_output_intermediate(keys: np.ndarray, plaintexts: np.ndarray) -> np.ndarray:
@@ -101,8 +216,152 @@ def unmasked_sbox_output_intermediate(keys: np.ndarray, plaintexts: np.ndarray)
     return Sbox[keys ^ plaintexts]
 
 
+class WelchTTest:
+    """
+    Batched Welch's t-test accumulator for fixed vs. random TVLA. Running means and sums of squared deviations (M2) of
+    both trace sets are merged block by block with Chan's parallel update, so the t-statistic only has to be evaluated
+    when it is actually requested.
+    """
+
+    def __init__(self):
+        self.n_traces = 0
+        self.mean_fixed = None
+        self.mean_random = None
+        self.m2_fixed = None
+        self.m2_random = None
+
+    @staticmethod
+    def _merge(n_a: int, mean_a: np.ndarray, m2_a: np.ndarray, block: np.ndarray) -> (np.ndarray, np.ndarray):
+        n_b = len(block)
+        mean_b = np.mean(block, axis=0)
+        m2_b = np.sum(np.square(block - mean_b), axis=0)
+
+        if n_a == 0:
+            return mean_b, m2_b
+
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * (n_b / n)
+        m2 = m2_a + m2_b + np.square(delta) * (n_a * n_b / n)
+        return mean, m2
+
+    def update(self, fixed_block: np.ndarray, random_block: np.ndarray) -> None:
+        """
+        Merges a block of fixed and random traces into the running statistics.
+        :param fixed_block: A block of fixed traces with shape (n_traces, n_samples)
+        :type fixed_block: np.ndarray
+        :param random_block: A block of random traces with the same shape as fixed_block
+        :type random_block: np.ndarray
+        :returns: None
+        :raises ValueError: if fixed_block and random_block do not have the same length
+        """
+        fixed_block = np.asarray(fixed_block, dtype=np.float64)
+        random_block = np.asarray(random_block, dtype=np.float64)
+
+        if len(fixed_block) != len(random_block):
+            raise ValueError("Length of fixed_block and random_block must be equal")
+        if len(fixed_block) == 0:
+            return
+
+        self.mean_fixed, self.m2_fixed = self._merge(self.n_traces, self.mean_fixed, self.m2_fixed, fixed_block)
+        self.mean_random, self.m2_random = self._merge(self.n_traces, self.mean_random, self.m2_random, random_block)
+        self.n_traces += len(fixed_block)
+
+    def t_statistic(self) -> np.ndarray:
+        """
+        Computes Welch's t-statistic of the traces merged so far.
+        :returns: The t-statistic at each time sample. All zeros if fewer than two trace pairs have been merged.
+        :rtype: np.ndarray
+        """
+        n = self.n_traces
+        if n < 2:
+            return np.zeros_like(self.mean_fixed)
+
+        var_fixed = self.m2_fixed / (n - 1)
+        var_random = self.m2_random / (n - 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.mean_random - self.mean_fixed) / np.sqrt(var_random / n + var_fixed / n)
+
+
+def t_max_at_checkpoints(fixed_t: np.ndarray, random_t: np.ndarray, checkpoints: Iterable[int],
+                         block_size: int = 1024) -> (np.ndarray, np.ndarray):
+    """
+    Computes t-max after each requested number of traces. Traces are merged in blocks of at most block_size rows and the
+    t-statistic is only evaluated at the checkpoints, so the cost of a t-max curve grows with the number of checkpoints
+    rather than with the number of traces.
+    :param fixed_t: The fixed trace set
+    :type fixed_t: np.ndarray
+    :param random_t: The random trace set
+    :type random_t: np.ndarray
+    :param checkpoints: The trace counts at which t-max is evaluated. Counts outside of [1, len(fixed_t)] are ignored.
+    :type checkpoints: Iterable[int]
+    :param block_size: The maximum number of traces merged at once
+    :type block_size: int
+    :return: The t-statistic over all traces and the t-max at each valid checkpoint in ascending order
+    :rtype: (np.ndarray, np.ndarray)
+    :raises ValueError: if fixed_t and random_t do not have the same length
+    """
+    if len(fixed_t) != len(random_t):
+        raise ValueError("Length of fixed_t and random_t must be equal")
+
+    num_traces = len(fixed_t)
+    checkpoints = np.unique(np.asarray(list(checkpoints), dtype=np.int64))
+    checkpoints = checkpoints[(checkpoints >= 1) & (checkpoints <= num_traces)]
+
+    accumulator = WelchTTest()
+    t_max = np.empty(len(checkpoints), dtype=np.float64)
+    position = 0
+
+    for i, checkpoint in enumerate(tqdm(checkpoints, desc="Calculating T-Test")):
+        while position < checkpoint:
+            end = min(checkpoint, position + block_size)
+            accumulator.update(fixed_t[position:end], random_t[position:end])
+            position = end
+        t_max[i] = np.max(np.abs(accumulator.t_statistic()))
+
+    if position < num_traces:
+        for start in range(position, num_traces, block_size):
+            accumulator.update(fixed_t[start:start + block_size], random_t[start:start + block_size])
+
+    return accumulator.t_statistic(), t_max
+
+
+def resolve_t_test_checkpoints(num_traces: int, checkpoints: int | Iterable[int] | str) -> np.ndarray:
+    """
+    Converts a t-max checkpoint schedule into the sorted trace counts at which t-max is evaluated. The last trace is
+    always included for int and "log" schedules.
+    :param num_traces: The total number of traces in the fixed and random sets
+    :type num_traces: int
+    :param checkpoints: An int stride (every `checkpoints` traces), an iterable of trace counts, or "log" for roughly ten
+                        logarithmically spaced checkpoints per decade starting after the sixth trace
+    :type checkpoints: int | Iterable[int] | str
+    :return: The sorted, unique trace counts in [1, num_traces]
+    :rtype: np.ndarray
+    :raises ValueError: if the schedule is not an int, an iterable of ints or "log"
+    """
+    if isinstance(checkpoints, str):
+        if checkpoints != "log":
+            raise ValueError("String checkpoint schedules must be 'log'")
+        if num_traces < 7:
+            schedule = np.array([num_traces])
+        else:
+            num_points = int(10 * math.log10(num_traces / 7)) + 2
+            schedule = np.append(np.geomspace(7, num_traces, num=num_points).astype(np.int64), num_traces)
+    elif isinstance(checkpoints, (int, np.integer)):
+        if checkpoints < 1:
+            raise ValueError("The checkpoint stride must be a positive integer")
+        schedule = np.append(np.arange(checkpoints, num_traces + 1, checkpoints), num_traces)
+    else:
+        schedule = np.asarray(list(checkpoints), dtype=np.int64)
+
+    schedule = np.unique(schedule)
+    return schedule[(schedule >= 1) & (schedule <= num_traces)]
+
+
 def t_test_tvla(fixed_t: np.ndarray, random_t: np.ndarray, visualize: bool = False,
-                visualization_paths: tuple = None) -> (np.ndarray, np.ndarray):
+                visualization_paths: tuple = None, checkpoints: int | Iterable[int] | str = None,
+                block_size: int = 1024) -> (np.ndarray, np.ndarray):
     """
     Computes the t-statistic and t-max between fixed and random trace sets. T-statistic magnitudes above or below
     |th| = 4.5 indicate cryptographic vulnerabilities.
@@ -115,62 +374,29 @@ def t_test_tvla(fixed_t: np.ndarray, random_t: np.ndarray, visualize: bool = Fal
     :type visualize: bool
     :param visualization_paths: The paths to be used to save the t-statistic (first idx) and t-max visualizations (second idx)
     :type visualization_paths: tuple
-    :return: The t-statistic at each time sample and t-max at each trace as a tuple of numpy arrays
+    :param checkpoints: The t-max schedule. Either an int stride, an iterable of trace counts or "log". If set to None,
+                        t-max is computed for every trace after the sixth and returned as a list.
+    :type checkpoints: int | Iterable[int] | str
+    :param block_size: The maximum number of traces merged into the running statistics at once
+    :type block_size: int
+    :return: The t-statistic at each time sample and t-max at each trace as a tuple of numpy arrays. If a checkpoint
+                schedule is supplied, t-max is instead a compact (n_checkpoints, 2) array of (n_traces, t_max) pairs.
     :rtype: (np.ndarray, np.ndarray)
     :raises ValueError: if fixed_t and random_t do not have the same length
     :Authors: Dev Mehta (dmmehta2@wpi.edu), Samuel Karkache (swkarkache@wpi.edu)
     """
-    welsh_t_outer = []
-    new_mr_outer = []
-    new_mf_outer = []
-    new_sf_outer = []
-    new_sr_outer = []
-    t_max_outer = []
-    fixed_t = np.array(fixed_t, dtype=np.float64)
-    random_t = np.array(random_t, dtype=np.float64)
-
     if len(fixed_t) != len(random_t):
         raise ValueError("Length of fixed_t and random_t must be equal")
 
-    def t_test_intermediate(mf_old, mr_old, sf_old, sr_old, new_tf, new_tr, n):
-        """
-        Inner function to help with t-test implementation. Not intended to be called outside this scope.
-        """
-        if n == 0:
-            new_mf = new_tf
-            new_mr = new_tr
-            new_sf = new_tf - new_mf
-            new_sr = new_tr - new_mr
-            welsh_t = new_sf
-
-            return welsh_t, new_mr, new_mf, new_sf, new_sr
-
-        elif n > 0:
-
-            new_mf = mf_old + (new_tf - mf_old) / (n + 1)
-            new_mr = mr_old + (new_tr - mr_old) / (n + 1)
-
-            new_sf = sf_old + (new_tf - mf_old) * (new_tf - new_mf)
-            new_sr = sr_old + (new_tr - mr_old) * (new_tr - new_mr)
-
-            new_stdf = np.sqrt(new_sf / n)
-            new_stdr = np.sqrt(new_sr / n)
-
-            try:
-                with np.errstate(divide='ignore'):
-                    welsh_t = np.array(new_mr - new_mf) / np.sqrt(
-                        np.array((new_stdr ** 2)) / (n + 1) + np.array((new_stdf ** 2)) / (n + 1))
-            except ZeroDivisionError:
-                welsh_t = 0
-
-            return welsh_t, new_mr, new_mf, new_sf, new_sr
-
-    for i in tqdm(range(len(random_t)), desc="Calculating T-Test"):
-        welsh_t_outer, new_mr_outer, new_mf_outer, new_sf_outer, new_sr_outer = (
-            t_test_intermediate(new_mf_outer, new_mr_outer, new_sf_outer, new_sr_outer, fixed_t[i], random_t[i], i))
-
-        if i > 5:  # remove edge effects
-            t_max_outer.append(max(abs(welsh_t_outer)))
+    if checkpoints is None:
+        # t-max is reported for every trace after the sixth to remove edge effects
+        welsh_t_outer, t_max_outer = t_max_at_checkpoints(fixed_t, random_t, range(7, len(random_t) + 1),
+                                                          block_size=block_size)
+        t_max_outer = list(t_max_outer)
+    else:
+        schedule = resolve_t_test_checkpoints(len(random_t), checkpoints)
+        welsh_t_outer, t_max = t_max_at_checkpoints(fixed_t, random_t, schedule, block_size=block_size)
+        t_max_outer = np.column_stack((schedule, t_max))
 
     if visualize:
         plt.plot(welsh_t_outer)
@@ -184,7 +410,10 @@ def t_test_tvla(fixed_t: np.ndarray, random_t: np.ndarray, visualize: bool = Fal
             plt.savefig(visualization_paths[0])
         plt.show()
 
-        plt.plot(t_max_outer)
+        if checkpoints is None:
+            plt.plot(t_max_outer)
+        else:
+            plt.plot(t_max_outer[:, 0], t_max_outer[:, 1])
         plt.title("T-Max as a Function of the Number of Traces")
         plt.xlabel("Number of Traces")
         plt.ylabel("T-Max")
@@ -221,26 +450,8 @@ def pearson_correlation(predicted_leakage: np.ndarray, observed_leakage: np.ndar
     if len(predicted_leakage) != len(observed_leakage):
         raise ValueError("The predicted_leakage and observed_leakage must have the same length")
 
-    num_traces = len(observed_leakage)
-    num_samples = len(observed_leakage[0])
-
-    observed_mean = np.mean(observed_leakage, axis=0)
-    predicted_mean = np.mean(predicted_leakage, axis=0)
-    top_sum_observed_predicted = np.zeros(num_samples)
-    bottom_sum_observed = np.zeros(num_samples)
-    bottom_sum_predicted = np.zeros(num_samples)
-
-    for i in range(num_traces):
-        observed_minus_mean = np.subtract(observed_leakage[i], observed_mean)
-        predicted_minus_mean = np.subtract(predicted_leakage[i], predicted_mean)
-
-        top_sum_observed_predicted = (
-            np.add(top_sum_observed_predicted, np.multiply(observed_minus_mean, predicted_minus_mean)))
-
-        bottom_sum_observed = np.add(bottom_sum_observed, np.square(observed_minus_mean))
-        bottom_sum_predicted = np.add(bottom_sum_predicted, np.square(predicted_minus_mean))
-
-    correlation = np.divide(top_sum_observed_predicted, np.sqrt(np.array(np.multiply(bottom_sum_observed, bottom_sum_predicted), dtype=np.float64)))
+    correlation = pearson_correlation_matrix(np.asarray(predicted_leakage, dtype=np.float64).ravel(),
+                                             observed_leakage)[0]
 
     if visualize:
         plt.plot(correlation)
@@ -255,8 +466,317 @@ def pearson_correlation(predicted_leakage: np.ndarray, observed_leakage: np.ndar
     return correlation
 
 
+def pearson_correlation_matrix(hypotheses: np.ndarray, traces: np.ndarray) -> np.ndarray:
+    """
+    Computes the correlation between the observed traces and every column of a hypothesis matrix at once. The
+    correlation of all key guesses is obtained from a single matrix product of the centered hypotheses and traces.
+
+    :param hypotheses: The predicted leakage of each key guess with shape (n_traces, n_guesses). A one-dimensional array
+                        is treated as a single guess.
+    :type hypotheses: np.ndarray
+    :param traces: The observed power traces with shape (n_traces, n_samples)
+    :type traces: np.ndarray
+    :return: The correlation traces of all guesses with shape (n_guesses, n_samples)
+    :rtype: np.ndarray
+    :raises ValueError: if hypotheses and traces do not have the same number of traces
+    """
+    hypotheses = np.asarray(hypotheses, dtype=np.float64)
+    if hypotheses.ndim == 1:
+        hypotheses = hypotheses.reshape(-1, 1)
+
+    traces = np.asarray(traces)
+    if traces.dtype == object:
+        traces = np.stack(traces)
+    traces = np.asarray(traces, dtype=np.float64)
+
+    if len(hypotheses) != len(traces):
+        raise ValueError("The hypotheses and traces must have the same number of traces")
+
+    centered_hypotheses = hypotheses - np.mean(hypotheses, axis=0)
+    centered_traces = traces - np.mean(traces, axis=0)
+
+    covariance = centered_hypotheses.T @ centered_traces
+    deviation = np.sqrt(np.outer(np.sum(np.square(centered_hypotheses), axis=0),
+                                 np.sum(np.square(centered_traces), axis=0)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance / deviation
+
+
+def difference_of_means(traces: np.ndarray, bits: np.ndarray) -> np.ndarray:
+    """
+    Computes the difference-of-means DPA trace of every key candidate and selection bit. The traces of each bit are
+    partitioned with one matrix product per bit instead of per-trace selection.
+
+    :param traces: The observed power traces with shape (n_traces, n_samples)
+    :type traces: np.ndarray
+    :param bits: The predicted selection bits with shape (n_traces, n_candidates, n_bits), for example from
+                    `LeakageModels.sbox_output_bits`
+    :type bits: np.ndarray
+    :return: The mean of the traces whose bit is 1 minus the mean of the traces whose bit is 0, with shape
+                (n_candidates, n_bits, n_samples)
+    :rtype: np.ndarray
+    :raises ValueError: if traces and bits do not have the same number of traces
+    """
+    traces = np.asarray(traces, dtype=np.float64)
+    bits = np.asarray(bits)
+
+    if len(traces) != len(bits):
+        raise ValueError("The traces and bits must have the same number of traces")
+
+    num_traces, num_candidates, num_bits = bits.shape
+    total = np.sum(traces, axis=0)
+    difference = np.empty((num_candidates, num_bits, traces.shape[1]), dtype=np.float64)
+
+    for b in range(num_bits):
+        selection = bits[:, :, b].astype(np.float64)
+        count_one = np.sum(selection, axis=0)[:, None]
+        sum_one = selection.T @ traces
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            difference[:, b] = sum_one / count_one - (total - sum_one) / (num_traces - count_one)
+
+    return difference
+
+
+def generate_hypotheses(leakage_model: str | Callable, plaintexts: np.ndarray, target_byte: int,
+                        key_candidates: Iterable = range(256), cache: bool = True) -> np.ndarray:
+    """
+    Generates the hypothesis matrix of a leakage model for a set of key candidates. See
+    `LeakageModels.hypothesis_matrix` for how the matrices are generated and cached.
+    :param leakage_model: The name of a registered leakage model or a leakage model function, in the form
+                        leakage_model(num_traces, plaintexts, subkey_guess, target_byte)
+    :type leakage_model: str | Callable
+    :param plaintexts: The plaintexts used during trace capture
+    :type plaintexts: np.ndarray
+    :param target_byte: The target byte of the key
+    :type target_byte: int
+    :param key_candidates: The key candidates, one column of the matrix each
+    :type key_candidates: Iterable
+    :param cache: Whether to look up and store the matrix in the shared hypothesis cache
+    :type cache: bool
+    :return: The predicted leakage with shape (n_traces, n_candidates)
+    :rtype: np.ndarray
+    """
+    return hypothesis_matrix(leakage_model, plaintexts, target_byte, key_candidates,
+                             cache=hypothesis_cache if cache else None)
+
+
+class IncrementalCPA:
+    """
+    Incremental correlation power analysis over all key candidates and target bytes. Only the running sums of the
+    traces, the hypotheses and their products are kept, so traces can be supplied in batches and the correlation and key
+    ranks can be read out after every batch.
+    """
+
+    def __init__(self, leakage_model: str | Callable, target_bytes: Iterable[int] = range(16),
+                 key_candidates: Iterable = range(256), correct_key: np.ndarray = None):
+        """
+        :param leakage_model: The leakage model function or the name of a registered leakage model
+        :type leakage_model: str | Callable
+        :param target_bytes: The key bytes to attack
+        :type target_bytes: Iterable[int]
+        :param key_candidates: The key candidates of each byte
+        :type key_candidates: Iterable
+        :param correct_key: The full correct key. If supplied, the rank of the correct key byte of each target byte is
+                            recorded in `rank_history` after every update.
+        :type correct_key: np.ndarray
+        """
+        self.leakage_model = leakage_model
+        self.target_bytes = list(target_bytes)
+        self.key_candidates = np.array(list(key_candidates))
+        self.correct_key = correct_key
+        self.rank_history = []
+        self.n_traces = 0
+
+        num_bytes = len(self.target_bytes)
+        num_candidates = len(self.key_candidates)
+        self.sum_h = np.zeros((num_bytes, num_candidates), dtype=np.float64)
+        self.sum_h2 = np.zeros((num_bytes, num_candidates), dtype=np.float64)
+        self.sum_x = None
+        self.sum_x2 = None
+        self.sum_hx = None
+        self._shift = None
+
+    def update(self, traces: np.ndarray, plaintexts: np.ndarray) -> None:
+        """
+        Adds a batch of traces and their plaintexts to the running sums.
+        :param traces: The batch of traces with shape (n_traces, n_samples)
+        :type traces: np.ndarray
+        :param plaintexts: The plaintexts of the batch with shape (n_traces, 16)
+        :type plaintexts: np.ndarray
+        :returns: None
+        :raises ValueError: if traces and plaintexts do not have the same length
+        """
+        if len(traces) != len(plaintexts):
+            raise ValueError("The traces and plaintexts must have the same length")
+        if len(traces) == 0:
+            return
+
+        self._accumulate(traces, [generate_hypotheses(self.leakage_model, plaintexts, target_byte, self.key_candidates,
+                                                      cache=False)
+                                  for target_byte in self.target_bytes])
+
+    def _accumulate(self, traces: np.ndarray, hypotheses: list[np.ndarray]) -> None:
+        """
+        Adds a batch of traces and precomputed hypotheses, one (n_traces, n_candidates) matrix per target byte, to the
+        running sums. Not intended to be called outside this class.
+        """
+        traces = np.asarray(traces, dtype=np.float64)
+
+        if self.sum_x is None:
+            num_samples = traces.shape[1]
+            self.sum_x = np.zeros(num_samples, dtype=np.float64)
+            self.sum_x2 = np.zeros(num_samples, dtype=np.float64)
+            self.sum_hx = np.zeros((len(self.target_bytes), len(self.key_candidates), num_samples), dtype=np.float64)
+            # accumulate around the mean of the first batch to limit cancellation in the sums
+            self._shift = np.mean(traces, axis=0)
+
+        traces = traces - self._shift
+        self.sum_x += np.sum(traces, axis=0)
+        self.sum_x2 += np.sum(np.square(traces), axis=0)
+
+        for i, byte_hypotheses in enumerate(hypotheses):
+            byte_hypotheses = np.asarray(byte_hypotheses, dtype=np.float64)
+            self.sum_h[i] += np.sum(byte_hypotheses, axis=0)
+            self.sum_h2[i] += np.sum(np.square(byte_hypotheses), axis=0)
+            self.sum_hx[i] += byte_hypotheses.T @ traces
+
+        self.n_traces += len(traces)
+
+        if self.correct_key is not None:
+            self.rank_history.append((self.n_traces, self.correct_key_rank()))
+
+    def correlation(self) -> np.ndarray:
+        """
+        Computes the correlation of all key candidates from the traces added so far.
+        :returns: The correlation traces with shape (n_target_bytes, n_candidates, n_samples)
+        :rtype: np.ndarray
+        """
+        n = self.n_traces
+        covariance = n * self.sum_hx - self.sum_h[:, :, None] * self.sum_x[None, None, :]
+        variance_h = n * self.sum_h2 - np.square(self.sum_h)
+        variance_x = n * self.sum_x2 - np.square(self.sum_x)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return covariance / np.sqrt(variance_h[:, :, None] * variance_x[None, None, :])
+
+    def scores(self) -> np.ndarray:
+        """
+        Scores every key candidate with the max absolute correlation of its correlation trace.
+        :returns: The scores with shape (n_target_bytes, n_candidates)
+        :rtype: np.ndarray
+        """
+        return np.nan_to_num(np.max(np.abs(self.correlation()), axis=2))
+
+    def key_ranks(self) -> np.ndarray:
+        """
+        Ranks the key candidates of each target byte from most to least likely.
+        :returns: The ranked key candidates with shape (n_target_bytes, n_candidates)
+        :rtype: np.ndarray
+        """
+        return self.key_candidates[np.argsort(-self.scores(), axis=1, kind='stable')]
+
+    def correct_key_rank(self, correct_key: np.ndarray = None) -> np.ndarray:
+        """
+        Computes the rank of the correct key byte of each target byte, where rank 0 is the best ranked candidate.
+        :param correct_key: The full correct key. Defaults to the key supplied to the constructor.
+        :type correct_key: np.ndarray
+        :returns: The rank of the correct key byte of each target byte
+        :rtype: np.ndarray
+        """
+        if correct_key is None:
+            correct_key = self.correct_key
+        correct_key = np.asarray(correct_key)[self.target_bytes]
+
+        return np.argmax(self.key_ranks() == correct_key[:, None], axis=1)
+
+
+def bootstrap_success_rate_guessing_entropy(traces: np.ndarray, plaintexts: np.ndarray, correct_key: np.ndarray,
+                                            trace_counts: Iterable[int], leakage_model: str | Callable,
+                                            num_experiments: int = 100, target_byte: int = 0,
+                                            key_candidates: Iterable = range(256), confidence: float = 0.95,
+                                            replace: bool = False, seed: int = None) -> tuple:
+    """
+    Estimates success rate and guessing entropy curves from a single trace set. Each experiment draws a random subset of
+    max(trace_counts) traces and runs an incremental CPA over it, reading the scores out at every trace count, so the
+    nested subsets of one experiment share their running sums. The hypotheses of the whole trace set are generated once
+    and reused by every experiment.
+    :param traces: The trace set to draw experiments from
+    :type traces: np.ndarray
+    :param plaintexts: The plaintexts of the trace set
+    :type plaintexts: np.ndarray
+    :param correct_key: The full correct key
+    :type correct_key: np.ndarray
+    :param trace_counts: The number of traces per experiment at which the success rate and guessing entropy are evaluated
+    :type trace_counts: Iterable[int]
+    :param leakage_model: The leakage model function or the name of a registered leakage model
+    :type leakage_model: str | Callable
+    :param num_experiments: The number of experiments
+    :type num_experiments: int
+    :param target_byte: The target byte of the key
+    :type target_byte: int
+    :param key_candidates: The key candidates
+    :type key_candidates: Iterable
+    :param confidence: The confidence level of the returned intervals
+    :type confidence: float
+    :param replace: Whether traces are drawn with replacement. Required if max(trace_counts) exceeds the number of traces.
+    :type replace: bool
+    :param seed: The seed of the random trace selection
+    :type seed: int
+    :return: The success rate with shape (n_trace_counts, n_candidates), where index o - 1 holds the success rate of
+                order o, the guessing entropy with shape (n_trace_counts,), and the lower and upper confidence bounds of
+                both with a leading axis of length 2. The intervals use the normal approximation.
+    :rtype: (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+    :raises ValueError: if traces and plaintexts do not have the same length or the trace counts exceed the number of
+                        traces when drawing without replacement
+    """
+    if len(traces) != len(plaintexts):
+        raise ValueError("The traces and plaintexts must have the same length")
+
+    trace_counts = np.unique(np.asarray(list(trace_counts), dtype=np.int64))
+    key_candidates = np.array(list(key_candidates))
+    num_traces = len(traces)
+
+    if not replace and trace_counts[-1] > num_traces:
+        raise ValueError("The trace counts cannot exceed the number of traces when drawing without replacement")
+
+    hypotheses = generate_hypotheses(leakage_model, plaintexts, target_byte, key_candidates)
+    correct_index = np.flatnonzero(key_candidates == np.asarray(correct_key)[target_byte])[0]
+    generator = np.random.default_rng(seed)
+    scores = np.empty((num_experiments, len(trace_counts), len(key_candidates)), dtype=np.float64)
+
+    for e in tqdm(range(num_experiments), desc="Running Success Rate Experiments"):
+        selection = generator.choice(num_traces, size=trace_counts[-1], replace=replace)
+        cpa = IncrementalCPA(leakage_model, target_bytes=[target_byte], key_candidates=key_candidates)
+        position = 0
+
+        for c, count in enumerate(trace_counts):
+            block = np.sort(selection[position:count])
+            cpa._accumulate(traces[block], [hypotheses[block]])
+            position = count
+            scores[e, c] = cpa.scores()[0]
+
+    ranks = correct_key_ranks(np.full(num_experiments, correct_index), scores=scores)
+    success_rate, guessing_entropy = success_rate_guessing_entropy_curves(
+        np.full(num_experiments, correct_index), scores=scores)
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    success_rate_margin = z * np.sqrt(success_rate * (1 - success_rate) / num_experiments)
+    success_rate_interval = np.stack((np.clip(success_rate - success_rate_margin, 0, 1),
+                                      np.clip(success_rate + success_rate_margin, 0, 1)))
+
+    log_ranks = np.log2(ranks + 1)
+    guessing_entropy_margin = z * np.std(log_ranks, axis=0, ddof=1) / math.sqrt(num_experiments) \
+        if num_experiments > 1 else np.zeros(len(trace_counts))
+    guessing_entropy_interval = np.stack((guessing_entropy - guessing_entropy_margin,
+                                          guessing_entropy + guessing_entropy_margin))
+
+    return success_rate, guessing_entropy, success_rate_interval, guessing_entropy_interval
+
+
 def score_and_rank(key_candidates: Iterable, target_byte: int, traces: np.ndarray, score_fcn: Callable,
-                   *args: any) -> np.ndarray:
+                   *args: any, n_jobs: int = 1) -> np.ndarray:
     """
     Scores and ranks a set of key candidates based on how likely they are to be the actual key.
 
@@ -269,11 +789,17 @@ def score_and_rank(key_candidates: Iterable, target_byte: int, traces: np.ndarra
     :param score_fcn: Callback to the scoring function used to score each key candidate. The score with correlation scoring
                     function is pre-defined and can be used. NOTE: User defined scoring functions must be in the form
                     score_fcn(traces, key_guess, target_byte, ...) to work with this metric. Your scoring function does not
-                    need to use all the required arguments, but they must be present as shown.
+                    need to use all the required arguments, but they must be present as shown. Scoring functions
+                    decorated with `batched_score_fcn` are called once with all key candidates instead of once per key.
     :type score_fcn: Callable
     :param args: Additional arguments for the scoring function supplied in score_fcn. For example, the predefined score with
                     correlation function requires plaintexts and a leakage model callback as additional arguments.
     :type args: Any
+    :param n_jobs: The number of worker processes the key candidates are split across. The traces and every numeric
+                    numpy array in args, such as the plaintexts, are placed in shared memory once instead of being
+                    pickled to every worker. score_fcn and the remaining args must be picklable (e.g. module level
+                    functions). On Windows the calling script must be guarded by `if __name__ == "__main__":`.
+    :type n_jobs: int
     :return: An numpy array of sorted tuples containing the key candidates and corresponding scores. For example, assuming that
                     numpy array `ranks` was returned from the metric, ranks[0][0] is the highest ranked key candidate and
                     ranks[0][1] is the score of the highest ranked key candidate.
@@ -281,39 +807,188 @@ def score_and_rank(key_candidates: Iterable, target_byte: int, traces: np.ndarra
     :Authors: Samuel Karkache (swkarkache@wpi.edu)
     """
 
-    dtype = [('key', int), ('score', 'float64')]
-    key_scores = np.array([], dtype=dtype)
+    key_candidates = np.array(list(key_candidates))
+
+    if n_jobs > 1 and len(key_candidates) > 1:
+        scores = _score_candidates_parallel(key_candidates, target_byte, traces, score_fcn, args, n_jobs)
+    else:
+        scores = _score_candidates(key_candidates, target_byte, traces, score_fcn, args)
+
+    return rank_key_scores(key_candidates, scores)
 
-    for k in key_candidates:
-        score_k = score_fcn(traces, k, target_byte, *args)
-        key_score = np.array([(k, score_k)], dtype=dtype)
-        key_scores = np.append(key_scores, key_score)
 
-    key_ranks = np.sort(key_scores, order='score')[::-1]
+def _score_candidates(key_candidates: np.ndarray, target_byte: int, traces: np.ndarray, score_fcn: Callable,
+                      args: tuple) -> np.ndarray:
+    """
+    Scores a set of key candidates in the current process. Not intended to be called outside this module.
+    """
+    if getattr(score_fcn, "batched", False):
+        return np.asarray(score_fcn(traces, key_candidates, target_byte, *args), dtype=np.float64)
+
+    scores = np.empty(len(key_candidates), dtype=np.float64)
+    for i, k in enumerate(key_candidates):
+        scores[i] = score_fcn(traces, k, target_byte, *args)
+    return scores
+
+
+# per-worker views of the shared trace set and array arguments used by _score_candidates_parallel
+_shared_arrays = []
+_shared_memory_blocks = []
+
+
+class _SharedArgument:
+    """
+    Placeholder for an array argument of the scoring function that is passed to the workers through shared memory. Not
+    intended to be used outside this module.
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+
+
+def _attach_shared_arrays(specs: list[tuple[str, tuple, np.dtype]]) -> None:
+    """
+    Pool initializer that maps the shared arrays into a worker process and registers a finalizer that releases them
+    when the worker exits. Not intended to be called outside this module.
+    """
+    global _shared_arrays, _shared_memory_blocks
+    for name, shape, dtype in specs:
+        block = shared_memory.SharedMemory(name=name)
+        _shared_memory_blocks.append(block)
+        _shared_arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    util.Finalize(None, _detach_shared_arrays, exitpriority=10)
+
+
+def _detach_shared_arrays() -> None:
+    """
+    Worker finalizer that drops the views of the shared arrays and closes the shared memory handles. Not intended to be
+    called outside this module.
+    """
+    global _shared_arrays, _shared_memory_blocks
+    _shared_arrays = []
+    for block in _shared_memory_blocks:
+        block.close()
+    _shared_memory_blocks = []
+
+
+def _score_shared_candidates(key_candidates: np.ndarray, target_byte: int, score_fcn: Callable,
+                             args: tuple) -> np.ndarray:
+    """
+    Worker function that scores a chunk of key candidates against the shared trace set. Not intended to be called
+    outside this module.
+    """
+    args = tuple(_shared_arrays[arg.index] if isinstance(arg, _SharedArgument) else arg for arg in args)
+    return _score_candidates(key_candidates, target_byte, _shared_arrays[0], score_fcn, args)
+
+
+def _score_candidates_parallel(key_candidates: np.ndarray, target_byte: int, traces: np.ndarray, score_fcn: Callable,
+                               args: tuple, n_jobs: int) -> np.ndarray:
+    """
+    Splits the key candidates across a process pool. The traces and every numeric array argument, such as the
+    plaintexts, are placed in shared memory once instead of being pickled to each worker. Not intended to be called
+    outside this module.
+    """
+    traces = np.asarray(traces)
+    if traces.dtype == object:
+        traces = np.stack(traces)
+
+    arrays = [traces]
+    shared_args = []
+    for arg in args:
+        if isinstance(arg, np.ndarray) and not arg.dtype.hasobject:
+            shared_args.append(_SharedArgument(len(arrays)))
+            arrays.append(arg)
+        else:
+            shared_args.append(arg)
+
+    blocks = []
+    try:
+        specs = []
+        for array in arrays:
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            specs.append((block.name, array.shape, array.dtype))
+
+        chunks = np.array_split(key_candidates, min(n_jobs, len(key_candidates)))
+        # close and join instead of terminating the pool so that the worker finalizers release the shared memory
+        pool = mp.Pool(len(chunks), initializer=_attach_shared_arrays, initargs=(specs,))
+        try:
+            results = pool.starmap(_score_shared_candidates,
+                                   [(chunk, target_byte, score_fcn, tuple(shared_args)) for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return np.concatenate(results)
+
+
+def rank_key_scores(key_candidates: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """
+    Sorts key candidates by score into the structured (key, score) array format returned by `score_and_rank`.
+    :param key_candidates: The key candidates
+    :type key_candidates: np.ndarray
+    :param scores: The score of each key candidate
+    :type scores: np.ndarray
+    :return: The key candidates and their scores from highest to lowest score. Ties are ordered by descending key.
+    :rtype: np.ndarray
+    """
+    key_candidates = np.asarray(key_candidates)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.lexsort((key_candidates, scores))[::-1]
+
+    key_ranks = np.empty(len(order), dtype=[('key', int), ('score', 'float64')])
+    key_ranks['key'] = key_candidates[order]
+    key_ranks['score'] = scores[order]
 
     return key_ranks
 
 
+def batched_score_fcn(score_fcn: Callable) -> Callable:
+    """
+    Marks a scoring function as able to score all key candidates in one call. `score_and_rank` then passes the whole
+    array of key candidates as the key_guess argument and expects an array with one score per candidate in return.
+    :param score_fcn: The scoring function
+    :type score_fcn: Callable
+    :return: The same scoring function
+    :rtype: Callable
+    """
+    score_fcn.batched = True
+    return score_fcn
+
+
+@batched_score_fcn
 def score_with_correlation(traces: np.ndarray, key_guess: any, target_byte: int, plaintexts: np.ndarray,
-                           leakage_model: Callable) -> Number:
+                           leakage_model: str | Callable) -> Number | np.ndarray:
     """
     Scoring function that assigns a key guess a score based on the max value of the pearson correlation.
     :param traces: The collected power traces
     :type traces: np.ndarray
-    :param key_guess: The key guess
+    :param key_guess: The key guess, or an array of key guesses to score all of them with one correlation matrix
     :type key_guess: any
     :param target_byte: The target byte of the key
     :type target_byte: int
     :param plaintexts: The plaintexts used during trace capture
     :type plaintexts: np.ndarray
-    :param leakage_model: The leakage model function. The hamming weight and hamming distance leakage model function are
-                        pre-defined in this library.
-    :type leakage_model: Callable
-    :return: The score of the key guess
-    :rtype: Number
+    :param leakage_model: The leakage model function or the name of a registered leakage model. The hamming weight and
+                        hamming distance leakage model function are pre-defined in this library.
+    :type leakage_model: str | Callable
+    :return: The score of the key guess, or an array of scores if an array of key guesses was supplied
+    :rtype: Number | np.ndarray
     :Authors: Samuel Karkache (swkarkache@wpi.edu)
     """
 
+    if np.ndim(key_guess) > 0:
+        hypotheses = generate_hypotheses(leakage_model, plaintexts[:len(traces)], target_byte, key_guess)
+        return np.max(np.abs(pearson_correlation_matrix(hypotheses, traces)), axis=1)
+
+    if isinstance(leakage_model, str):
+        leakage_model = get_leakage_model(leakage_model)
+
     # generate the predicted leakage
     predicted_leakage = leakage_model(len(traces), plaintexts, key_guess, target_byte)
 
@@ -340,24 +1015,91 @@ def success_rate_guessing_entropy(correct_keys: np.ndarray, experiment_ranks: np
     :rtype: (Number, Number)
     :Authors: Samuel Karkache (swkarkache@wpi)
     """
-    success_rate = 0
-    guessing_entropy = 0
+    ranked_keys = np.asarray(experiment_ranks[:num_experiments])
+    if ranked_keys.dtype == object:
+        ranked_keys = np.stack([_ranked_keys(ranks) for ranks in ranked_keys])
+    elif ranked_keys.dtype.names is None and ranked_keys.ndim > 2:
+        # (key, score) pairs
+        ranked_keys = ranked_keys[..., 0]
+    ranks = correct_key_ranks(np.asarray(correct_keys)[:num_experiments], ranked_keys)
 
-    # for each experiment
-    for i in range(num_experiments):
+    success_rate = float(np.count_nonzero(ranks < order)) / num_experiments
+
+    # guessing entropy is the log2 of the rank of the correct key
+    guessing_entropy = float(np.sum(np.log2(ranks + 1))) / num_experiments
+
+    return success_rate, guessing_entropy
+
+
+def _ranked_keys(ranks: np.ndarray) -> np.ndarray:
+    """
+    Extracts the ranked key candidates from a (key, score) ranking. Not intended to be called outside this module.
+    """
+    ranks = np.asarray(ranks)
+    if ranks.dtype.names is not None:
+        return ranks['key']
+    if ranks.dtype == object or ranks.ndim > 1:
+        return np.array([key_and_score[0] for key_and_score in ranks])
+    return ranks
 
-        # check if correct key is within 'order' number of ranks
-        for j in range(order):
-            if experiment_ranks[i][j][0] == correct_keys[i]:
-                success_rate += 1
-                break
 
-        # guessing entropy is the log2 of the rank of the correct key
-        guessing_entropy += math.log2(
-            [idx for idx, key_and_score in enumerate(experiment_ranks[i]) if key_and_score[0] == correct_keys[i]][
-                0] + 1)
+def correct_key_ranks(correct_keys: np.ndarray, ranked_keys: np.ndarray = None, scores: np.ndarray = None) -> np.ndarray:
+    """
+    Computes the rank of the correct key in every experiment with array comparisons, where rank 0 is the best ranked key.
+    :param correct_keys: The correct key of each experiment with shape (n_experiments,)
+    :type correct_keys: np.ndarray
+    :param ranked_keys: The key candidates of each experiment ordered from most to least likely, with shape
+                        (n_experiments, n_keys) or (n_experiments, n_trace_counts, n_keys). Structured arrays returned by
+                        `score_and_rank` are also accepted.
+    :type ranked_keys: np.ndarray
+    :param scores: Alternative to ranked_keys. The score of each key candidate, indexed by key value, with the same shape
+                    as ranked_keys. Candidates tied with the correct key do not count against it.
+    :type scores: np.ndarray
+    :return: The rank of the correct key with shape (n_experiments,) or (n_experiments, n_trace_counts)
+    :rtype: np.ndarray
+    :raises ValueError: if neither or both of ranked_keys and scores are supplied
+    """
+    if (ranked_keys is None) == (scores is None):
+        raise ValueError("Exactly one of ranked_keys and scores must be supplied")
+
+    correct_keys = np.asarray(correct_keys).astype(np.int64)
+
+    if scores is not None:
+        scores = np.asarray(scores, dtype=np.float64)
+        index = correct_keys.reshape(correct_keys.shape + (1,) * (scores.ndim - 1))
+        correct_scores = np.take_along_axis(scores, index, axis=-1)
+        return np.count_nonzero(scores > correct_scores, axis=-1)
+
+    ranked_keys = np.asarray(ranked_keys)
+    if ranked_keys.dtype.names is not None:
+        ranked_keys = ranked_keys['key']
+    matches = ranked_keys == correct_keys.reshape(correct_keys.shape + (1,) * (ranked_keys.ndim - 1))
+    return np.argmax(matches, axis=-1)
+
+
+def success_rate_guessing_entropy_curves(correct_keys: np.ndarray, ranked_keys: np.ndarray = None,
+                                         scores: np.ndarray = None) -> (np.ndarray, np.ndarray):
+    """
+    Computes the success rate of every order and the guessing entropy over all experiments at once, optionally for
+    several trace counts.
+    :param correct_keys: The correct key of each experiment with shape (n_experiments,)
+    :type correct_keys: np.ndarray
+    :param ranked_keys: The key candidates of each experiment ordered from most to least likely, with shape
+                        (n_experiments, n_keys) or (n_experiments, n_trace_counts, n_keys)
+    :type ranked_keys: np.ndarray
+    :param scores: Alternative to ranked_keys. The score of each key candidate, indexed by key value, with the same shape
+                    as ranked_keys.
+    :type scores: np.ndarray
+    :return: The success rate with shape ([n_trace_counts,] n_keys), where index o - 1 holds the success rate of order o,
+                and the guessing entropy with shape ([n_trace_counts,])
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    ranks = correct_key_ranks(correct_keys, ranked_keys=ranked_keys, scores=scores)
+    num_keys = (ranked_keys if ranked_keys is not None else scores).shape[-1]
 
-    success_rate = success_rate / num_experiments
-    guessing_entropy = guessing_entropy / num_experiments
+    # histogram of the correct key ranks along the experiment axis, then cumulative counts give every order at once
+    rank_counts = np.apply_along_axis(np.bincount, 0, ranks, minlength=num_keys)
+    success_rate = np.moveaxis(np.cumsum(rank_counts, axis=0), 0, -1) / ranks.shape[0]
+    guessing_entropy = np.mean(np.log2(ranks + 1), axis=0)
 
     return success_rate, guessing_entropy